@@ -0,0 +1,29 @@
+/*
+Secondary indexes for the crawl's hot queries (see crawler.py and tie_extractor.py). Run this after 0_create_tables.sql
+on a new database, or once on an existing one: every index is created only if it doesn't exist yet.
+
+The queue and metadata indexes are partial: they only hold the rows still to be handled (unprocessed queue entries,
+subreddits without metadata or marked unsuccessful), so they stay small however big the tables grow, and the queue
+counts and scans are answered from the index alone (check them with check_query_plans.py).
+
+On a live database with millions of rows, run each statement with CREATE INDEX CONCURRENTLY instead to avoid blocking
+the crawl while it builds.
+*/
+
+-- Unprocessed queue entries, in the order the steps read them (step, subreddit)
+CREATE INDEX IF NOT EXISTS t1a_hyperlink_queue_unprocessed_idx ON t1a_hyperlink_queue (step, subreddit) WHERE processed = 0;
+CREATE INDEX IF NOT EXISTS t1b_reference_queue_unprocessed_idx ON t1b_reference_queue (step, subreddit) WHERE processed = 0;
+CREATE INDEX IF NOT EXISTS t1c_moderator_queue_unprocessed_idx ON t1c_moderator_queue (step, subreddit) WHERE processed = 0;
+
+-- Subreddits whose metadata hasn't been pulled yet, and those marked unsuccessful (private/no longer exist)
+CREATE INDEX IF NOT EXISTS t2_subreddit_metadata_missing_idx ON t2_subreddit_metadata (subreddit) WHERE has_metadata = 0;
+CREATE INDEX IF NOT EXISTS t2_subreddit_metadata_unsuccessful_idx ON t2_subreddit_metadata (subreddit) WHERE has_metadata = -1;
+
+-- Subreddits with metadata but no complete_metadata_text (scraped by an older crawl; see backfill_metadata_text.py)
+CREATE INDEX IF NOT EXISTS t2_subreddit_metadata_missing_text_idx ON t2_subreddit_metadata (subreddit) WHERE has_metadata = 1 AND complete_metadata_text IS NULL;
+
+-- Incoming ties (the primary keys only cover lookups by source) and the ties through each moderator
+CREATE INDEX IF NOT EXISTS t1a_hyperlink_ties_target_idx ON t1a_hyperlink_ties (target);
+CREATE INDEX IF NOT EXISTS t1b_reference_ties_target_idx ON t1b_reference_ties (target);
+CREATE INDEX IF NOT EXISTS t1c_moderator_ties_target_idx ON t1c_moderator_ties (target);
+CREATE INDEX IF NOT EXISTS t1c_moderator_ties_label_idx ON t1c_moderator_ties (label);
@@ -142,3 +142,11 @@ CREATE TABLE public.t1c_moderator_ties (
     CONSTRAINT t1c_moderator_ties_target_fkey FOREIGN KEY (target) REFERENCES t2_subreddit_metadata(subreddit),
     CONSTRAINT t1c_moderator_ties_label_fkey FOREIGN KEY (label) REFERENCES t2_moderator_metadata(username)
 );
+
+CREATE TABLE t2_account_status (
+    username text NOT NULL,
+    account_id text NULL,
+    status text NOT NULL,
+    checked_at timestamp DEFAULT NOW(),
+    CONSTRAINT t2_account_status_pkey PRIMARY KEY (username)
+);
@@ -0,0 +1,96 @@
+from cassette import Cassette
+from db_utils import init_db, close_db
+import metrics
+from crawler import crawl, scrape_moderator_roles, text_relations
+from moderator_cache import ModeratorRoleCache
+from rate_limiter import RateLimiter
+from reddit_api import init_reddit_session
+from response_cache import ResponseCache
+from tie_extractor import TieExtractor
+
+
+"""
+Runs the hyperlink, reference and shared moderator snowballs
+(2_hyperlink_tracing.py and 3_shared_moderator_tracing.py) together.
+
+The t1a/t1b/t1c queues stay separate frontiers, but every round pulls the
+metadata (including moderators and rules) of every queued subreddit that
+doesn't have it yet once, whichever queues it's in, and then hands it to each
+relation: the hyperlink and reference ties are extracted from the text in one
+pass, and the shared moderator ties from the moderators. On overlapping
+crawls this pulls each subreddit's metadata once instead of once per script.
+
+Set `reddit_config_path` and `db_config_path` as described in
+2_hyperlink_tracing.py, and add the seed subreddits to whichever queues should
+be crawled.
+"""
+
+reddit_config_path = "/Users/lgs17/Desktop/Reddit Collab 2022/code/reddit_config.txt"
+
+db_config_path = "/Users/lgs17/Desktop/Reddit Collab 2022/code/db_config.txt"
+
+## Number of subreddits to scrape metadata for at the same time, and the
+## request budget they (and the moderator role requests) all share
+metadata_workers = 8
+requests_per_minute = 60
+
+## "python" streams the text through the tie extractor (and its worker
+## processes); "database" extracts each snowball level inside the database
+## with a few set-based statements (see tie_extractor.extract_ties_in_db)
+snowball_engine = "python"
+
+rate_limiter = RateLimiter(requests_per_minute = requests_per_minute)
+
+## Set to True to read responses fetched within their time to live (by this or
+## any other script) from disk instead, without taking a permit (see
+## response_cache.py). It's opened under the main guard below.
+use_response_cache = False
+response_cache = None
+
+## Set to a file name (e.g. "outputs/crawl_cassette.jsonl.gz") to record every
+## API exchange for an offline replay with fake_reddit.py (see cassette.py).
+## It's opened under the main guard below, so the tie extractor's worker
+## processes don't truncate it when they re-import this file.
+cassette_path = None
+cassette = None
+
+## Metrics (see metrics.py): a JSON snapshot is appended to `metrics_path`
+## every `metrics_interval` seconds; set `metrics_port` to also serve them to
+## Prometheus at http://127.0.0.1:PORT/metrics
+metrics_path = "outputs/crawl_metrics.jsonl"
+metrics_interval = 60
+metrics_port = None
+
+
+## Authenticate an API session (one per worker thread)
+def session_factory():
+    return init_reddit_session(reddit_config_path, rate_limiter = rate_limiter, cache = response_cache, cassette = cassette)
+
+
+## The tie extractor's worker processes re-import this file, so the crawl only
+## runs when it's executed as a script
+if __name__ == "__main__":
+    if use_response_cache:
+        response_cache = ResponseCache()
+    if cassette_path:
+        cassette = Cassette(cassette_path)
+
+    metrics.start(metrics_path, interval = metrics_interval, prometheus_port = metrics_port)
+    ## One connection per metadata worker (each reaches the database through
+    ## the account status cache), plus the main thread's and a streaming cursor's
+    init_db(db_config_path, max_size = metadata_workers + 2)
+
+    moderator_cache = ModeratorRoleCache(scrape_moderator_roles)
+    with TieExtractor(text_relations) as extractor:
+        crawl(session_factory, extractor = extractor, moderator_cache = moderator_cache, metadata_workers = metadata_workers, snowball_engine = snowball_engine)
+    print("Hyperlinks, references and shared moderators done.")
+
+    rate_limiter.print_stats()
+    if response_cache:
+        response_cache.print_stats()
+        response_cache.close()
+    if cassette:
+        cassette.print_stats()
+        cassette.close()
+    metrics.stop()
+    close_db()
@@ -0,0 +1,94 @@
+import threading
+
+from db_utils import execute_in_db
+
+
+"""
+Persistent cache of whether Reddit accounts still exist, used to drop deleted
+and suspended moderators from the metadata rows without loading every
+moderator's profile.
+
+Statuses are kept in the t2_account_status table (username, account fullname,
+status, checked_at; created by 0_create_tables.sql) and in memory for the run.
+check() answers from memory first, then from the table (entries younger than
+`ttl_days`), and looks the rest up through /api/user_data_by_account_ids, 100
+accounts per request. That endpoint leaves out accounts that are suspended or
+deleted, so those are stored as "unavailable"; the rest as "exists".
+
+With `persist = False` the table isn't used and the statuses are only kept in
+memory (for scripts that run without a database, e.g. seed_metadata.py).
+"""
+
+select_status_sql = """ SELECT username, status FROM t2_account_status WHERE username = ANY(%s) AND checked_at > NOW() - %s * INTERVAL '1 day' """
+upsert_status_sql = """ INSERT INTO t2_account_status (username, account_id, status, checked_at) VALUES (%s, %s, %s, NOW())
+    ON CONFLICT (username) DO UPDATE SET account_id = EXCLUDED.account_id, status = EXCLUDED.status, checked_at = EXCLUDED.checked_at """
+
+## /api/user_data_by_account_ids takes up to 100 fullnames per request
+lookup_batch_size = 100
+
+
+## {fullname: user data} for the accounts that exist (or None for accounts
+## that can't be looked up)
+def fetch_user_data(session, fullnames):
+    return session.request(method = "GET", path = "/api/user_data_by_account_ids", params = {"ids": ",".join(fullnames)}) or {}
+
+
+class AccountStatusCache:
+
+    def __init__(self, ttl_days = 30, persist = True):
+        self.ttl_days = ttl_days
+        self.persist = persist
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.db_reads = 0
+        self.api_lookups = 0
+
+    ## Takes [(username, account fullname)] and returns {username: whether
+    ## the account exists}
+    def check(self, session, accounts):
+        accounts = dict([(username, fullname) for username, fullname in accounts if username])
+        exists = {}
+
+        with self.lock:
+            for username in accounts:
+                if username in self.statuses:
+                    exists[username] = self.statuses[username] == "exists"
+            self.hits += len(exists)
+
+        missing = [username for username in accounts if username not in exists]
+        if missing and self.persist:
+            stored = execute_in_db(select_status_sql, return_results = True, args = [missing, self.ttl_days])
+            with self.lock:
+                for username, status in stored:
+                    exists[username] = status == "exists"
+                    self.statuses[username] = status
+                self.db_reads += len(missing)
+
+        ## Look the rest up in batches (accounts without a fullname can't be
+        ## looked up, so they're assumed to exist)
+        unchecked = [username for username in accounts if username not in exists]
+        rows = []
+        for start in range(0, len(unchecked), lookup_batch_size):
+            batch = unchecked[start:start + lookup_batch_size]
+            fullnames = [accounts[username] for username in batch if accounts[username]]
+            found = fetch_user_data(session, fullnames) if fullnames else {}
+            with self.lock:
+                self.api_lookups += 1
+            for username in batch:
+                status = "exists" if not accounts[username] or accounts[username] in found else "unavailable"
+                exists[username] = status == "exists"
+                rows.append((username, accounts[username], status))
+
+        if rows:
+            if self.persist:
+                execute_in_db(upsert_status_sql, args = rows, batch_insert = True)
+            with self.lock:
+                for username, _, status in rows:
+                    self.statuses[username] = status
+
+        return exists
+
+    def print_stats(self):
+        print("account status cache: {} cached, {} hits, {} read from the database, {} lookup requests".format(len(self.statuses), self.hits, self.db_reads, self.api_lookups), flush=True)
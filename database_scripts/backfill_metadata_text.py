@@ -0,0 +1,60 @@
+import argparse
+
+from db_utils import init_db, close_db, execute_in_db, stream_query, transaction
+from reddit_json import complete_metadata_text, complete_text_columns
+
+
+"""
+Fills in the derived metadata columns (complete_metadata_text and
+created_utc_ts) of rows scraped before the crawler built them at ingest time
+(see reddit_json.py). The crawl no longer runs an UPDATE over the whole
+metadata table every round to fill them in, so rows from older crawls need
+this once.
+
+The text is built with the same function the crawler uses
+(reddit_json.complete_metadata_text), streamed out and written back
+`batch_size` rows per transaction; only rows with metadata and no complete
+text are touched, unless --rebuild is given (e.g. after the text
+normalization changes), in which case every row with metadata is rebuilt.
+
+python backfill_metadata_text.py ../../db_config.txt [--batch-size 2000] [--rebuild]
+"""
+
+select_rows_sql = """ SELECT subreddit, {}, rules::TEXT FROM t2_subreddit_metadata WHERE has_metadata = 1 {} """
+update_text_sql = """ UPDATE t2_subreddit_metadata SET complete_metadata_text = %s WHERE subreddit = %s """
+update_timestamps_sql = """ UPDATE t2_subreddit_metadata SET created_utc_ts = to_timestamp(created_utc)
+    WHERE has_metadata = 1 AND created_utc_ts IS NULL AND created_utc IS NOT NULL """
+
+
+## Build and write complete_metadata_text for the rows that need it. Returns
+## the number of rows updated.
+def backfill_complete_text(batch_size = 2000, rebuild = False):
+    select_q = select_rows_sql.format(", ".join(complete_text_columns), "" if rebuild else "AND complete_metadata_text IS NULL")
+
+    updated = 0
+    for rows in stream_query(select_q, batch_size = batch_size):
+        with transaction():
+            execute_in_db(update_text_sql, args = [(complete_metadata_text(row[1:]), row[0]) for row in rows], batch_insert = True)
+        updated += len(rows)
+        print("\t{} rows updated".format(updated), flush=True)
+    return updated
+
+
+## Fill in created_utc_ts where it's missing (one set-based UPDATE)
+def backfill_timestamps():
+    with transaction() as cursor:
+        execute_in_db(update_timestamps_sql)
+        return cursor.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Fill in complete_metadata_text and created_utc_ts for existing metadata rows")
+    parser.add_argument("db_config_path")
+    parser.add_argument("--batch-size", type = int, default = 2000, help = "rows per transaction")
+    parser.add_argument("--rebuild", action = "store_true", help = "rebuild the text of every row with metadata, not only the missing ones")
+    args = parser.parse_args()
+
+    init_db(args.db_config_path)
+    print("{} complete texts written.".format(backfill_complete_text(batch_size = args.batch_size, rebuild = args.rebuild)), flush=True)
+    print("{} timestamps filled in.".format(backfill_timestamps()), flush=True)
+    close_db()
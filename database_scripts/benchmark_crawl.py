@@ -0,0 +1,340 @@
+import argparse
+import bisect
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import tempfile
+from itertools import accumulate
+from time import perf_counter, strftime
+
+import psycopg
+
+
+"""
+Benchmark of the snowball crawl (crawler.py) on synthetic subreddit graphs.
+
+For each graph size, generate_fixture() builds a fake Reddit with:
+    - a power-law link structure: every subreddit links to one earlier
+      subreddit (so everything is reachable from the seed) plus a
+      Pareto-distributed number of others, picked with Zipf popularity, so a
+      few subreddits collect most of the links,
+    - description text with those links written the ways real subreddits
+      write them (r/NAME, /r/NAME, reddit.com/r/NAME), plus a few links to
+      subreddits that don't exist and some private subreddits, and
+    - moderators drawn from a shared pool with Zipf popularity, so moderator
+      overlap (and a few deleted moderator accounts) look like the real thing.
+
+The fixture is served by fake_reddit.py, and the full crawl (metadata, text
+ties and shared moderator ties, as in 4_unified_crawl.py) runs from the seed
+subreddit into a throwaway database built from 0_create_tables.sql and
+0_create_indexes.sql. Each size runs in its own process, so peak RSS is per
+size.
+
+Reported per size: subreddits crawled per second, ties found per second,
+database round trips (execute_in_db / bulk_insert / stream_query calls) and
+API requests per subreddit, seconds per step and peak RSS (of the crawl
+process and of its tie extraction workers).
+
+Run with:
+
+python benchmark_crawl.py ADMIN_DB_CONFIG [--sizes 1000 10000 100000] [--latency-ms 0] [--json-out results.json]
+
+ADMIN_DB_CONFIG is a db config file (see db_utils.py) for a local Postgres
+user that can create databases; a database named snowball_bench_<size>_<pid>
+is created for each run and dropped afterwards (unless --keep-db).
+"""
+
+schema_paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ["0_create_tables.sql", "0_create_indexes.sql"]]
+
+filler_words = ["community", "discussion", "memes", "news", "support", "questions", "art", "photos", "help", "daily",
+    "weekly", "thread", "welcome", "rules", "please", "read", "posts", "about", "fans", "related", "check", "out", "also", "our", "sister", "subs"]
+link_formats = ["r/{}", "/r/{}", "https://www.reddit.com/r/{}", "reddit.com/r/{}/"]
+
+
+def subreddit_name(index):
+    return "sub{:06d}".format(index)
+
+
+def moderator_name(index):
+    return "mod{:06d}".format(index)
+
+
+## Draw indexes below `size` with Zipf popularity (index i has weight 1/(i+1)^s)
+class ZipfSampler:
+
+    def __init__(self, size, s = 1.1):
+        self.cum_weights = list(accumulate([1.0 / (i + 1) ** s for i in range(size)]))
+
+    def sample(self, rng):
+        return bisect.bisect_left(self.cum_weights, rng.random() * self.cum_weights[-1])
+
+
+## Description text with the given links scattered through filler words
+def make_text(rng, targets, num_words):
+    words = [rng.choice(filler_words) for _ in range(num_words)]
+    for target in targets:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(link_formats).format(target))
+    return " ".join(words)
+
+
+## A fake_reddit.py fixture for a graph of `num_nodes` subreddits (the seed is
+## subreddit 0)
+def generate_fixture(num_nodes, seed = 0, mean_extra_links = 3.0, missing_rate = 0.02, private_rate = 0.01, deleted_moderator_rate = 0.05):
+    rng = random.Random(seed)
+    link_popularity = ZipfSampler(num_nodes)
+    num_moderators = max(1, num_nodes // 2)
+    moderator_popularity = ZipfSampler(num_moderators, s = 0.9)
+
+    subreddits = {}
+    moderated = {}
+    for index in range(num_nodes):
+        name = subreddit_name(index)
+
+        ## One link from an earlier subreddit keeps the graph connected;
+        ## the rest follow a power law (Pareto with shape 2 has mean 2, so
+        ## scale it to `mean_extra_links`)
+        targets = set()
+        if index > 0:
+            subreddits[subreddit_name(rng.randrange(index))]["links"].add(name)
+        num_extra = int((rng.paretovariate(2.0) - 1.0) * mean_extra_links)
+        for _ in range(min(num_extra, 200)):
+            if rng.random() < missing_rate:
+                targets.add("gone{:06d}".format(rng.randrange(num_nodes)))
+            else:
+                targets.add(subreddit_name(link_popularity.sample(rng)))
+        targets.discard(name)
+
+        moderators = set([moderator_name(moderator_popularity.sample(rng)) for _ in range(1 + int(rng.expovariate(0.5)))])
+        for moderator in moderators:
+            moderated.setdefault(moderator, []).append(name)
+
+        subreddits[name] = {
+            "status": 403 if index > 0 and rng.random() < private_rate else 200,
+            "links": targets,
+            "moderators": sorted(moderators),
+            "rules": [{"short_name": "Be nice", "description": make_text(rng, [], 12)}],
+        }
+
+    ## Write the text once every subreddit's links are known
+    for index in range(num_nodes):
+        name = subreddit_name(index)
+        subreddit = subreddits[name]
+        links = sorted(subreddit.pop("links"))
+        rng.shuffle(links)
+        split = len(links) // 2
+        subreddit["about"] = {
+            "display_name": name,
+            "title": "The {} {}".format(name, rng.choice(filler_words)),
+            "public_description": make_text(rng, links[:split], 15),
+            "description": make_text(rng, links[split:], 40),
+            "submit_text": make_text(rng, [], 10),
+            "subscribers": int(rng.paretovariate(1.2) * 100),
+            "created_utc": 1200000000.0 + rng.random() * 500000000.0,
+            "over18": rng.random() < 0.1,
+            "lang": "en",
+        }
+
+    users = {}
+    for moderator, subreddit_names in moderated.items():
+        if rng.random() >= deleted_moderator_rate:
+            users[moderator] = {"created_utc": 1300000000.0, "moderated": subreddit_names}
+
+    return {"subreddits": subreddits, "users": users, "search": {}}
+
+
+##########################
+## Throwaway database ##
+##########################
+
+## The lines of a db config file, with dbname replaced if given
+def read_db_config(db_config_path, dbname = None):
+    with open(db_config_path) as f:
+        lines = [line.strip() for line in f.readlines() if line.strip()]
+    if dbname:
+        lines = [line for line in lines if not line.startswith("dbname")] + ["dbname='{}'".format(dbname)]
+    return lines
+
+
+def connect(db_config_path, dbname = None):
+    return psycopg.connect(" ".join(read_db_config(db_config_path, dbname)), autocommit = True)
+
+
+def create_database(admin_db_config_path, dbname, config_dir):
+    with connect(admin_db_config_path) as conn:
+        conn.execute("CREATE DATABASE {}".format(dbname))
+    with connect(admin_db_config_path, dbname) as conn:
+        for schema_path in schema_paths:
+            with open(schema_path) as f:
+                conn.execute(f.read())
+
+    db_config_path = os.path.join(config_dir, "db_config.txt")
+    with open(db_config_path, "w") as f:
+        f.write("\n".join(read_db_config(admin_db_config_path, dbname)) + "\n")
+    return db_config_path
+
+
+def drop_database(admin_db_config_path, dbname):
+    with connect(admin_db_config_path) as conn:
+        conn.execute("DROP DATABASE IF EXISTS {}".format(dbname))
+
+
+def write_reddit_config(server, config_dir):
+    url = "http://{}:{}".format(*server.server_address)
+    reddit_config_path = os.path.join(config_dir, "reddit_config.txt")
+    with open(reddit_config_path, "w") as f:
+        f.write("user_agent=snowball-benchmark by u/benchmark\nclient_id=benchmark\nclient_secret=benchmark\nusername=benchmark\npassword=benchmark\n")
+        f.write("oauth_url={}\nreddit_url={}\n".format(url, url))
+    return reddit_config_path
+
+
+###########
+## Crawl ##
+###########
+
+## Run the full crawl from the seed in this (fresh) process and put the
+## measurements on `results`
+def run_crawl(db_config_path, reddit_config_path, seeds, metadata_workers, verbose, results):
+    import crawler
+    import db_utils
+    from moderator_cache import ModeratorRoleCache
+    from rate_limiter import RateLimiter
+    from reddit_api import init_reddit_session
+    from tie_extractor import TieExtractor
+
+    ## Effectively unlimited: the fake server's latency (if any) is the cost
+    rate_limiter = RateLimiter(requests_per_minute = 10 ** 9, burst = 10 ** 6, name = "benchmark")
+
+    def session_factory():
+        return init_reddit_session(reddit_config_path, rate_limiter = rate_limiter)
+
+    ## Time each step (crawl() looks them up on the module)
+    step_seconds = {}
+    for step_name in ["metadata_step", "snowball_step", "moderator_step"]:
+        def timed(*args, step = getattr(crawler, step_name), step_name = step_name, **kwargs):
+            start = perf_counter()
+            try:
+                return step(*args, **kwargs)
+            finally:
+                step_seconds[step_name] = step_seconds.get(step_name, 0.0) + perf_counter() - start
+        setattr(crawler, step_name, timed)
+
+    db_utils.init_db(db_config_path, max_size = metadata_workers + 2)
+    for queue_table in [relation.queue_table for relation in crawler.text_relations] + [crawler.moderator_queue]:
+        db_utils.enqueue_subreddits(seeds, queue_table, 0)
+    db_utils.execute_in_db(""" UPDATE t2_subreddit_metadata SET seed = 1 WHERE subreddit = ANY(%s) """, args = [seeds])
+    db_utils.query_stats.clear()
+
+    output = open(os.devnull, "w") if not verbose else None
+    start = perf_counter()
+    with (contextlib.redirect_stdout(output) if output else contextlib.nullcontext()):
+        with TieExtractor(crawler.text_relations) as extractor:
+            crawler.crawl(session_factory, extractor = extractor, moderator_cache = ModeratorRoleCache(crawler.scrape_moderator_roles), metadata_workers = metadata_workers)
+    elapsed = perf_counter() - start
+    if output:
+        output.close()
+
+    round_trips = sum([stats[0] for stats in db_utils.query_stats.values()])
+    nodes = db_utils.execute_in_db(""" SELECT COUNT(*) FROM t2_subreddit_metadata WHERE has_metadata <> 0 """, return_first_only = True)[0]
+    edges = sum([db_utils.execute_in_db(""" SELECT COUNT(*) FROM {} """.format(table), return_first_only = True)[0] for table in ["t1a_hyperlink_ties", "t1b_reference_ties", "t1c_moderator_ties"]])
+    db_utils.close_db(print_stats = verbose)
+
+    results.put({
+        "nodes": nodes,
+        "edges": edges,
+        "seconds": elapsed,
+        "nodes_per_second": nodes / elapsed,
+        "edges_per_second": edges / elapsed,
+        "db_round_trips_per_node": round_trips / max(nodes, 1),
+        "api_requests_per_node": rate_limiter.stats()["requests"] / max(nodes, 1),
+        "step_seconds": step_seconds,
+        ## ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    })
+
+
+## The crawl process's result, checking every `poll_seconds` that it's still
+## running: one that dies without a result (killed, out of memory, a crash in
+## a worker) raises instead of leaving the benchmark waiting forever
+def wait_for_result(process, results, poll_seconds = 5):
+    while True:
+        ## Checked before the wait, so a result put just before exiting is
+        ## still picked up
+        alive = process.is_alive()
+        try:
+            return results.get(timeout = poll_seconds)
+        except queue.Empty:
+            if not alive:
+                raise RuntimeError("The crawl process exited with code {} without a result".format(process.exitcode))
+
+
+## Benchmark one graph size. Returns the measurements.
+def benchmark_size(admin_db_config_path, num_nodes, seed = 0, latency_ms = 0.0, metadata_workers = 8, keep_db = False, verbose = False):
+    from fake_reddit import serve_fixture
+
+    print("Generating a {} subreddit graph...".format(num_nodes), flush=True)
+    fixture = generate_fixture(num_nodes, seed = seed)
+    server = serve_fixture(fixture, latency_ms = latency_ms)
+
+    dbname = "snowball_bench_{}_{}".format(num_nodes, os.getpid())
+    config_dir = tempfile.mkdtemp(prefix = "snowball_bench_")
+    try:
+        db_config_path = create_database(admin_db_config_path, dbname, config_dir)
+        reddit_config_path = write_reddit_config(server, config_dir)
+
+        print("Crawling...", flush=True)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        process = context.Process(target = run_crawl, args = (db_config_path, reddit_config_path, [subreddit_name(0)], metadata_workers, verbose, results))
+        process.start()
+        result = wait_for_result(process, results)
+        process.join()
+    finally:
+        server.shutdown()
+        shutil.rmtree(config_dir, ignore_errors = True)
+        if not keep_db:
+            drop_database(admin_db_config_path, dbname)
+
+    result["graph_size"] = num_nodes
+    return result
+
+
+def print_results(results):
+    print("{:>8} {:>8} {:>9} {:>9} {:>10} {:>11} {:>9} {:>9} {:>10}".format(
+        "graph", "crawled", "ties", "nodes/s", "edges/s", "db trips/n", "api req/n", "rss MB", "wkr rss MB"), flush=True)
+    for result in results:
+        print("{:>8} {:>8} {:>9} {:>9.1f} {:>10.1f} {:>11.2f} {:>9.2f} {:>9.1f} {:>10.1f}".format(
+            result["graph_size"], result["nodes"], result["edges"], result["nodes_per_second"], result["edges_per_second"],
+            result["db_round_trips_per_node"], result["api_requests_per_node"], result["peak_rss_mb"], result["peak_worker_rss_mb"]), flush=True)
+        print("\t" + ", ".join(["{} {:.1f}s".format(step, seconds) for step, seconds in sorted(result["step_seconds"].items())]), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the snowball crawl on synthetic subreddit graphs")
+    parser.add_argument("admin_db_config_path")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 10000, 100000])
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed for the graphs")
+    parser.add_argument("--latency-ms", type = float, default = 0.0, help = "fake API latency per request")
+    parser.add_argument("--metadata-workers", type = int, default = 8)
+    parser.add_argument("--keep-db", action = "store_true", help = "don't drop the benchmark databases")
+    parser.add_argument("--verbose", action = "store_true", help = "show the crawl's own output")
+    parser.add_argument("--json-out", help = "also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for num_nodes in args.sizes:
+        results.append(benchmark_size(args.admin_db_config_path, num_nodes, seed = args.seed, latency_ms = args.latency_ms,
+            metadata_workers = args.metadata_workers, keep_db = args.keep_db, verbose = args.verbose))
+        print_results(results[-1:])
+
+    print("\nSummary:", flush=True)
+    print_results(results)
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"timestamp": strftime("%Y-%m-%d %H:%M:%S"), "seed": args.seed, "latency_ms": args.latency_ms, "results": results}, f, indent = 2)
@@ -0,0 +1,122 @@
+import gzip
+import json
+import threading
+from time import strftime
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+
+"""
+Record every Reddit API exchange of a run to a cassette file, so the run can
+be replayed offline by fake_reddit.py (`--cassette FILE`).
+
+Format version 1 is JSON Lines, gzip-compressed when the file name ends in
+.gz. The first line is a header:
+
+{"format": "reddit_cassette", "version": 1, "timestamp": "..."}
+
+and every following line is one exchange:
+
+{"request": "GET /r/dogs/about?raw_json=1", "status": 200, "elapsed": 0.21, "body": "..."}
+
+`request` is the normalized request (request_key(): the method, the path
+lowercased without the host, a trailing slash or `.json`, and the sorted
+query parameters), so a replay matches it whichever host the scripts are
+pointed at. Only the first response to each request is kept; the OAuth token
+exchange and transient errors (429s and 5xx responses, which the scripts
+retry) are never written.
+
+Cassette.attach(session) records through a requests.Session response hook;
+pass `cassette` to keyword_search.search_keywords() or reddit_api.init_reddit
+/ init_reddit_session() to record the search and API paths.
+"""
+
+format_name = "reddit_cassette"
+format_version = 1
+
+## Requests that are never recorded (the token exchange carries credentials)
+skipped_paths = ["/api/v1/access_token"]
+
+
+## The normalized form of a request: method, path (lowercased, without the
+## host, a trailing slash or `.json`) and the sorted query parameters (which
+## can be in the URL or in `params`)
+def request_key(method, url, params = None):
+    url = urlsplit(url)
+    path = url.path.lower().rstrip("/")
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    query = parse_qsl(url.query)
+    if params:
+        query.extend([(key, str(value)) for key, value in (params.items() if hasattr(params, "items") else params)])
+    return "{} {}?{}".format(method.upper(), path, urlencode(sorted(query)))
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding = "utf-8")
+    return open(path, mode, encoding = "utf-8")
+
+
+class Cassette:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = _open(path, "w")
+        self.seen = set()
+        self.exchange_count = 0
+        self.duplicate_count = 0
+        header = {"format": format_name, "version": format_version, "timestamp": strftime("%Y-%m-%d %H:%M:%S")}
+        self.f.write(json.dumps(header) + "\n")
+
+    ## Write an exchange unless the same request has already been recorded.
+    ## Returns whether it was written.
+    def record(self, method, url, status, body, elapsed = 0.0):
+        if urlsplit(url).path.rstrip("/") in skipped_paths or status == 429 or status >= 500:
+            return False
+        request = request_key(method, url)
+        line = json.dumps({"request": request, "status": status, "elapsed": round(elapsed, 3), "body": body})
+        with self.lock:
+            if request in self.seen:
+                self.duplicate_count += 1
+                return False
+            self.seen.add(request)
+            self.f.write(line + "\n")
+            self.exchange_count += 1
+        return True
+
+    ## requests response hook
+    def record_response(self, response, *args, **kwargs):
+        elapsed = response.elapsed.total_seconds() if response.elapsed else 0.0
+        self.record(response.request.method, response.request.url, response.status_code, response.text, elapsed)
+
+    ## Record every response `session` (a requests.Session) receives
+    def attach(self, session):
+        session.hooks["response"].append(self.record_response)
+        return session
+
+    def print_stats(self):
+        print("cassette {}: {} exchanges recorded ({} repeated requests skipped)".format(self.path, self.exchange_count, self.duplicate_count), flush=True)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+## Read a cassette into {request key: (status, body, elapsed seconds)}
+def load_cassette(path):
+    with _open(path, "r") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != format_name:
+            raise ValueError("{} is not a cassette file".format(path))
+        exchanges = {}
+        for line in f:
+            exchange = json.loads(line)
+            exchanges.setdefault(exchange["request"], (exchange["status"], exchange["body"], exchange.get("elapsed", 0.0)))
+    return exchanges
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+from benchmark_crawl import connect, create_database, drop_database, generate_fixture, subreddit_name
+
+
+"""
+Checks that moderator_projection.py rebuilds exactly the shared moderator ties
+crawler.moderator_step() writes.
+
+A fixture graph from benchmark_crawl.generate_fixture() is loaded into a
+throwaway database (built from 0_create_tables.sql and 0_create_indexes.sql):
+every subreddit's moderator listing (deleted accounts stored as null, private
+subreddits marked unsuccessful) and every moderator's roles, with a few
+moderators marked skip or without roles, and a few roles pointing outside the
+fixture or at a subreddit whose listing doesn't name the moderator (as when the
+two were pulled at different times). Every `seed_spacing`th subreddit is queued in the moderator queue at
+step 0 and moderator_step() is run until the queue is empty (no API is
+involved: the roles are all in the table already; between steps the
+subreddits found outside the fixture are marked unsuccessful, as
+metadata_step() would).
+
+The ties moderator_step() wrote are then compared with the ones
+moderator_projection.recompute_moderator_ties(replace = True) writes in their
+place; the script prints the differences and exits with status 1 if there
+are any (or if moderator_step() wrote no ties at all, as there would be
+nothing to compare).
+
+Run with:
+
+python check_moderator_parity.py ADMIN_DB_CONFIG [--nodes 2000] [--seed 0] [--keep-db]
+"""
+
+## Share of moderators marked skip, without roles (has_metadata = -1), with
+## one extra role outside the fixture, and with one extra role on a fixture
+## subreddit that doesn't list them
+skip_rate = 0.03
+no_roles_rate = 0.03
+outside_role_rate = 0.05
+unlisted_role_rate = 0.05
+
+## Stop a crawl that hasn't emptied the queue after this many steps
+max_steps = 1000
+
+## Queue every `seed_spacing`th fixture subreddit
+seed_spacing = 100
+
+
+## ([(subreddit, has_metadata, moderators JSON)], [(username, has_metadata,
+## skip, subreddits moderated)]) for a fixture graph
+def fixture_rows(num_nodes, seed):
+    fixture = generate_fixture(num_nodes, seed = seed)
+    rng = random.Random(seed)
+
+    subreddit_rows = []
+    listed = set()
+    for name, subreddit in sorted(fixture["subreddits"].items()):
+        if subreddit["status"] != 200:
+            subreddit_rows.append((name, -1, None))
+            continue
+        moderators = [moderator if moderator in fixture["users"] else None for moderator in subreddit["moderators"]]
+        listed.update([moderator for moderator in moderators if moderator])
+        subreddit_rows.append((name, 1, json.dumps(moderators)))
+
+    moderator_rows = []
+    for username in sorted(listed):
+        draw = rng.random()
+        if draw < no_roles_rate:
+            moderator_rows.append((username, -1, 0, None))
+            continue
+        roles = list(fixture["users"][username]["moderated"])
+        if rng.random() < outside_role_rate:
+            roles.append("outside{:06d}".format(rng.randrange(num_nodes)))
+        if rng.random() < unlisted_role_rate:
+            roles.append(subreddit_name(rng.randrange(num_nodes)))
+        moderator_rows.append((username, 1, 1 if draw < no_roles_rate + skip_rate else 0, roles))
+    return (subreddit_rows, moderator_rows)
+
+
+def load_fixture(conn, subreddit_rows, moderator_rows, seeds):
+    with conn.cursor() as cursor:
+        with cursor.copy(""" COPY t2_subreddit_metadata (subreddit, has_metadata, moderators) FROM STDIN """) as copy:
+            for row in subreddit_rows:
+                copy.write_row(row)
+        with cursor.copy(""" COPY t2_moderator_metadata (username, has_metadata, skip, subreddits_moderated) FROM STDIN """) as copy:
+            for row in moderator_rows:
+                copy.write_row(row)
+        cursor.executemany(""" INSERT INTO t1c_moderator_queue (subreddit, step) VALUES (%s, 0) """, [(seed,) for seed in seeds])
+    conn.execute("VACUUM ANALYZE")
+
+
+## Scraping roles would need the API; every listed moderator is in the table
+def no_scrape(session, username):
+    raise RuntimeError("{} isn't in t2_moderator_metadata".format(username))
+
+
+## Run moderator_step() until the moderator queue is empty. Returns the
+## number of steps.
+def run_moderator_steps():
+    from crawler import check_num_unprocessed, moderator_queue, moderator_step
+    from db_utils import execute_in_db
+    from moderator_cache import ModeratorRoleCache
+
+    mark_outside_sql = """ UPDATE t2_subreddit_metadata SET has_metadata = -1 WHERE has_metadata = 0 """
+
+    moderator_cache = ModeratorRoleCache(no_scrape)
+    steps = 0
+    while check_num_unprocessed(moderator_queue) > 0:
+        if steps == max_steps:
+            raise RuntimeError("moderator_step didn't empty the queue in {} steps".format(max_steps))
+        execute_in_db(mark_outside_sql)
+        moderator_step(None, moderator_cache)
+        steps += 1
+    return steps
+
+
+def read_ties(conn):
+    return set(conn.execute(""" SELECT source, target, label FROM t1c_moderator_ties """).fetchall())
+
+
+## Print the ties only one side has. Returns whether they differ.
+def compare(crawled, rebuilt, examples = 10):
+    only_crawled = sorted(crawled - rebuilt)
+    only_rebuilt = sorted(rebuilt - crawled)
+    print("{} t1c_moderator_ties: {} rows from moderator_step, {} from the projection".format("ok  " if not (only_crawled or only_rebuilt) else "DIFF", len(crawled), len(rebuilt)), flush=True)
+    for name, rows in [("moderator_step", only_crawled), ("the projection", only_rebuilt)]:
+        if rows:
+            print("\t{} ties only from {}, e.g. {}".format(len(rows), name, rows[:examples]), flush=True)
+    return bool(only_crawled or only_rebuilt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check that moderator_projection.py rebuilds the ties moderator_step writes")
+    parser.add_argument("admin_db_config_path")
+    parser.add_argument("--nodes", type = int, default = 2000, help = "subreddits in the fixture graph")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed for the graph")
+    parser.add_argument("--keep-db", action = "store_true", help = "don't drop the database")
+    args = parser.parse_args()
+
+    import db_utils
+    from moderator_projection import recompute_moderator_ties
+
+    subreddit_rows, moderator_rows = fixture_rows(args.nodes, args.seed)
+    dbname = "moderator_parity_{}".format(os.getpid())
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            db_config_path = create_database(args.admin_db_config_path, dbname, config_dir)
+            with connect(args.admin_db_config_path, dbname) as conn:
+                load_fixture(conn, subreddit_rows, moderator_rows, [subreddit_name(index) for index in range(0, args.nodes, seed_spacing)])
+
+            db_utils.init_db(db_config_path)
+            print("Running moderator_step over {} subreddits and {} moderators...".format(len(subreddit_rows), len(moderator_rows)), flush=True)
+            print("{} steps".format(run_moderator_steps()), flush=True)
+            with connect(args.admin_db_config_path, dbname) as conn:
+                crawled = read_ties(conn)
+
+            inserted, counts, _ = recompute_moderator_ties(replace = True)
+            db_utils.close_db(print_stats = False)
+            with connect(args.admin_db_config_path, dbname) as conn:
+                rebuilt = read_ties(conn)
+    finally:
+        if not args.keep_db:
+            drop_database(args.admin_db_config_path, dbname)
+
+    differing = compare(crawled, rebuilt) or not crawled
+    print("moderator_step wrote no ties" if not crawled else "The projection differs from moderator_step" if differing else "The projection rebuilt the same ties", flush=True)
+    sys.exit(1 if differing else 0)
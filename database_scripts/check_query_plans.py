@@ -0,0 +1,173 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import psycopg
+
+from benchmark_crawl import connect, create_database, drop_database
+from crawler import text_relations, moderator_queue, moderator_edges, unprocessed_count_sql, queue_depth_sql, unprocessed_queue_sql, mark_no_metadata_sql, missing_metadata_sql, missing_text_sql
+from tie_extractor import unprocessed_text_sql
+
+
+"""
+Checks the query plans of the crawl's hot queries (the queue and metadata
+queries in crawler.py and tie_extractor.py, plus lookups of the ties into a
+subreddit and through a moderator) with EXPLAIN, so a schema or query change
+that drops them back to sequential scans is caught before a crawl with
+millions of rows runs into it.
+
+By default it builds a throwaway database from 0_create_tables.sql and
+0_create_indexes.sql (with the helpers in benchmark_crawl.py), fills it with
+`--rows` synthetic subreddits (each in all three queues, with a small
+unprocessed frontier and a few subreddits missing metadata or marked
+unsuccessful) and their ties, VACUUM ANALYZEs it and checks every plan:
+
+    - index only: every scan of the table is an Index Only Scan (the queue
+      counts and queue reads, answered from the partial indexes alone)
+    - index: every scan of the table uses an index (no Seq Scan)
+
+Each check prints the scans in its plan; the script exits with status 1 if
+any check fails. Keep `--rows` large: on small tables a sequential scan is
+the planner's right call (e.g. with 20000 rows it hashes the whole queues for
+metadata_step), so only the default size says anything about a real crawl.
+
+Run with:
+
+python check_query_plans.py ADMIN_DB_CONFIG [--rows 1000000] [--keep-db] [--show-plans]
+
+or, to check an existing crawl database as it is (nothing is written):
+
+python check_query_plans.py DB_CONFIG --existing
+"""
+
+## Fill the throwaway database: `{n}` subreddits, 1% of them missing metadata
+## and 1% marked unsuccessful, 2% of each queue unprocessed, one hyperlink,
+## reference and moderator tie out of every subreddit
+populate_sql = [
+    """ INSERT INTO t2_subreddit_metadata (subreddit, has_metadata, complete_metadata_text)
+        SELECT 'sub' || i, CASE WHEN i % 100 = 0 THEN 0 WHEN i % 100 = 1 THEN -1 ELSE 1 END, 'see r/sub' || ((i::bigint * 7919) % {n} + 1)
+        FROM generate_series(1, {n}) i """,
+    """ INSERT INTO t2_moderator_metadata (username, has_metadata) SELECT 'mod' || j, 1 FROM generate_series(1, {n} / 10 + 1) j """,
+] + [""" INSERT INTO {} (subreddit, processed, step)
+        SELECT 'sub' || i, CASE WHEN i % 50 = 0 THEN 0 ELSE 1 END, i % 8 FROM generate_series(1, {{n}}) i """.format(queue_table)
+    for queue_table in [relation.queue_table for relation in text_relations] + [moderator_queue]
+] + [""" INSERT INTO {} (source, target)
+        SELECT 'sub' || i, 'sub' || ((i::bigint * 7919) % {{n}} + 1) FROM generate_series(1, {{n}}) i ON CONFLICT DO NOTHING """.format(relation.edges_table)
+    for relation in text_relations
+] + [
+    """ INSERT INTO {} (source, target, label)
+        SELECT 'sub' || i, 'sub' || ((i::bigint * 104729) % {{n}} + 1), 'mod' || (i % ({{n}} / 10 + 1) + 1) FROM generate_series(1, {{n}}) i ON CONFLICT DO NOTHING """.format(moderator_edges),
+]
+
+
+## (name, query, arguments, {table: "index only" or "index"}) for every
+## query whose plan is checked
+def plan_checks():
+    text_queues = [relation.queue_table for relation in text_relations]
+    queue_tables = text_queues + [moderator_queue]
+
+    checks = []
+    for queue_table in queue_tables:
+        checks.append(("check_num_unprocessed({})".format(queue_table), unprocessed_count_sql.format(queue = queue_table), None, {queue_table: "index only"}))
+        checks.append(("record_queue_depth({})".format(queue_table), queue_depth_sql.format(queue = queue_table), None, {queue_table: "index only"}))
+        checks.append(("mark_no_metadata({})".format(queue_table), mark_no_metadata_sql.format(queue = queue_table), None, {queue_table: "index", "t2_subreddit_metadata": "index"}))
+
+    missing_metadata_tables = dict([(queue_table, "index") for queue_table in queue_tables])
+    missing_metadata_tables["t2_subreddit_metadata"] = "index"
+    checks.append(("metadata_step", missing_metadata_sql(queue_tables), None, missing_metadata_tables))
+
+    missing_text_tables = dict([(queue_table, "index") for queue_table in text_queues])
+    missing_text_tables["t2_subreddit_metadata"] = "index"
+    checks.append(("fill_missing_text", missing_text_sql(text_queues), None, missing_text_tables))
+
+    ## The metadata rows of the frontier are read whichever way is cheapest for
+    ## its size; the queues themselves have to come from the partial indexes
+    checks.append(("extract_ties", unprocessed_text_sql(text_queues), None, dict([(queue_table, "index only") for queue_table in text_queues])))
+    checks.append(("moderator_step", unprocessed_queue_sql.format(queue = moderator_queue), None, {moderator_queue: "index only"}))
+
+    for edges_table in [relation.edges_table for relation in text_relations] + [moderator_edges]:
+        checks.append(("ties into a subreddit ({})".format(edges_table), """ SELECT source FROM {} WHERE target = %s """.format(edges_table), ["sub42"], {edges_table: "index"}))
+    checks.append(("ties through a moderator", """ SELECT source, target FROM {} WHERE label = %s """.format(moderator_edges), ["mod7"], {moderator_edges: "index"}))
+    return checks
+
+
+## Every scan node in an EXPLAIN (FORMAT JSON) plan, as (node type, table,
+## index)
+def plan_scans(plan):
+    scans = []
+    if plan["Node Type"].endswith("Scan") and "Relation Name" in plan:
+        index_name = plan.get("Index Name")
+        if index_name is None and plan["Node Type"] == "Bitmap Heap Scan":
+            index_name = ", ".join([child.get("Index Name", "?") for child in plan.get("Plans", [])])
+        scans.append((plan["Node Type"], plan["Relation Name"], index_name))
+    for child in plan.get("Plans", []):
+        scans.extend(plan_scans(child))
+    return scans
+
+
+def scan_problems(scans, requirements):
+    problems = []
+    for node_type, table, index_name in scans:
+        requirement = requirements.get(table)
+        if requirement == "index only" and node_type != "Index Only Scan":
+            problems.append("{} on {} (expected an Index Only Scan)".format(node_type, table))
+        elif requirement == "index" and node_type not in ["Index Scan", "Index Only Scan", "Bitmap Heap Scan"]:
+            problems.append("{} on {} (expected an index scan)".format(node_type, table))
+    return problems
+
+
+## EXPLAIN every check on `conn`. Returns the number of failed checks.
+def check_plans(conn, show_plans = False):
+    failures = 0
+    cursor = psycopg.ClientCursor(conn)
+    for name, query, args, requirements in plan_checks():
+        plan = cursor.execute("EXPLAIN (FORMAT JSON) " + query, args).fetchone()[0][0]["Plan"]
+        scans = plan_scans(plan)
+        problems = scan_problems(scans, requirements)
+        failures += bool(problems)
+
+        print("{} {}".format("FAIL" if problems else "ok  ", name), flush=True)
+        for node_type, table, index_name in scans:
+            print("\t{} on {}{}".format(node_type, table, " using {}".format(index_name) if index_name else ""), flush=True)
+        for problem in problems:
+            print("\t!! {}".format(problem), flush=True)
+        if show_plans:
+            text_plan = cursor.execute("EXPLAIN " + query, args).fetchall()
+            print("\n".join(["\t\t" + line for line, in text_plan]), flush=True)
+    return failures
+
+
+def populate(conn, num_rows):
+    for query in populate_sql:
+        conn.execute(query.format(n = num_rows))
+    conn.execute("VACUUM ANALYZE")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check that the crawl's hot queries use the queue and ties indexes")
+    parser.add_argument("db_config_path", help = "admin db config (or, with --existing, the crawl database's db config)")
+    parser.add_argument("--rows", type = int, default = 1000000, help = "synthetic subreddits in the throwaway database")
+    parser.add_argument("--existing", action = "store_true", help = "check the database in DB_CONFIG as it is")
+    parser.add_argument("--keep-db", action = "store_true", help = "don't drop the throwaway database")
+    parser.add_argument("--show-plans", action = "store_true", help = "also print the full plans")
+    args = parser.parse_args()
+
+    if args.existing:
+        with connect(args.db_config_path) as conn:
+            failures = check_plans(conn, show_plans = args.show_plans)
+    else:
+        dbname = "query_plans_{}_{}".format(args.rows, os.getpid())
+        try:
+            print("Filling {} with {} subreddits...".format(dbname, args.rows), flush=True)
+            with tempfile.TemporaryDirectory() as config_dir:
+                create_database(args.db_config_path, dbname, config_dir)
+            with connect(args.db_config_path, dbname) as conn:
+                populate(conn, args.rows)
+                failures = check_plans(conn, show_plans = args.show_plans)
+        finally:
+            if not args.keep_db:
+                drop_database(args.db_config_path, dbname)
+
+    print("{} checks failed".format(failures) if failures else "All plans use the indexes", flush=True)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,177 @@
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from benchmark_crawl import connect, create_database, drop_database, generate_fixture, subreddit_name
+
+
+"""
+Checks that the two snowball engines (crawler.snowball_step with engine
+"python" and "database", see tie_extractor.py) build the same graph.
+
+A fixture graph from benchmark_crawl.generate_fixture() is loaded into two
+throwaway databases (built from 0_create_tables.sql and 0_create_indexes.sql),
+with every subreddit's complete_metadata_text already filled in (private
+subreddits are marked unsuccessful), plus a handful of subreddits whose text
+has the awkward cases in it (capitals, mentions inside words, tabs, newlines
+and non-ASCII whitespace before a mention, chained links, self links). The
+seed is queued in the hyperlink and reference queues at step 0, along with a
+few other subreddits at later steps (so a level mixes steps, as it does when
+seeds are added to a running crawl), and each database is snowballed with one
+of the engines until both queues are empty (no API is involved: the metadata
+is all there already). The python engine reads each level `--batch-size`
+subreddits at a time, small enough by default that the levels span several
+batches and a subreddit can be reached from a lower step in a later batch.
+
+The ties, the queues (processed flags and steps) and the metadata stubs of
+the two databases are then compared row for row; the script prints the
+differences and exits with status 1 if there are any.
+
+Run with:
+
+python check_snowball_parity.py ADMIN_DB_CONFIG [--nodes 2000] [--seed 0] [--batch-size 50] [--keep-db]
+"""
+
+engines = ["python", "database"]
+
+## Texts for the extra subreddits edge00, edge01, ... (linked from the seed)
+edge_case_texts = [
+    "Reddit.com/r/CaseSensitive reddit.com/r/MixedCase R/Capital r/Lowered",
+    "see:r/nospace and xr/inword and (r/paren) r/a/r/b",
+    "tab\tr/tabbed newline\nr/newlined nbsp\u00a0r/nbsp ideographic\u3000r/wide",
+    "reddit\ncom/r/dotnewline reddit-com/r/dotother https://old.reddit.com/r/Old/comments/abc",
+    "/r/slashed //r/doubleslash r/ r/_under-score r/edge04",
+    "r/reddit.com/r/chained reddit.com/r/reddit.com/r/chained2 r/sub000001",
+]
+
+## What's compared: {table: columns}
+compared_tables = {
+    "t1a_hyperlink_ties": "source, target, label",
+    "t1b_reference_ties": "source, target, label",
+    "t1a_hyperlink_queue": "subreddit, processed, step",
+    "t1b_reference_queue": "subreddit, processed, step",
+    "t2_subreddit_metadata": "subreddit, has_metadata",
+}
+
+## Stop a snowball that hasn't emptied its queues after this many levels
+max_levels = 1000
+
+## Queue every `late_seed_spacing`th fixture subreddit too, at step 1 to
+## `late_seed_steps`
+late_seed_spacing = 50
+late_seed_steps = 4
+
+
+## [(subreddit, has_metadata, complete_metadata_text)] for a fixture graph
+## plus the edge case subreddits
+def fixture_rows(num_nodes, seed):
+    fixture = generate_fixture(num_nodes, seed = seed)
+    rows = []
+    for name, subreddit in sorted(fixture["subreddits"].items()):
+        if subreddit["status"] != 200:
+            rows.append((name, -1, None))
+            continue
+        about = subreddit["about"]
+        text = " ".join([about["display_name"], about["title"], about["description"], about["submit_text"], about["public_description"]] + [rule["description"] for rule in subreddit["rules"]])
+        if name == subreddit_name(0):
+            text += " " + " ".join(["r/edge{:02d}".format(index) for index in range(len(edge_case_texts))])
+        rows.append((name, 1, text))
+    for index, text in enumerate(edge_case_texts):
+        rows.append(("edge{:02d}".format(index), 1, text))
+    return rows
+
+
+## [(subreddit, step)] to queue before the snowball starts
+def fixture_seeds(num_nodes):
+    return [(subreddit_name(0), 0)] + [(subreddit_name(index), index // late_seed_spacing % late_seed_steps + 1) for index in range(late_seed_spacing, num_nodes, late_seed_spacing)]
+
+
+def load_fixture(conn, rows, seeds):
+    with conn.cursor() as cursor:
+        with cursor.copy(""" COPY t2_subreddit_metadata (subreddit, has_metadata, complete_metadata_text) FROM STDIN """) as copy:
+            for row in rows:
+                copy.write_row(row)
+        for queue_table in ["t1a_hyperlink_queue", "t1b_reference_queue"]:
+            cursor.executemany(""" INSERT INTO {} (subreddit, step) VALUES (%s, %s) """.format(queue_table), seeds)
+    conn.execute("VACUUM ANALYZE")
+
+
+## Snowball the database in `db_config_path` with `engine` until the text
+## queues are empty. Returns (levels, seconds).
+def run_snowball(db_config_path, engine, batch_size):
+    import db_utils
+    from crawler import check_num_unprocessed, snowball_step, text_relations
+    from tie_extractor import TieExtractor
+
+    db_utils.init_db(db_config_path)
+    levels = 0
+    start = perf_counter()
+    with TieExtractor(text_relations) as extractor:
+        while sum([check_num_unprocessed(relation.queue_table) for relation in text_relations]) > 0:
+            if levels == max_levels:
+                raise RuntimeError("the {} snowball didn't finish in {} levels".format(engine, max_levels))
+            snowball_step(extractor, engine = engine, batch_size = batch_size)
+            levels += 1
+    elapsed = perf_counter() - start
+    db_utils.close_db(print_stats = False)
+    return (levels, elapsed)
+
+
+## {table: set of rows} for the compared tables of one database
+def read_tables(conn):
+    return dict([(table, set(conn.execute(""" SELECT {} FROM {} """.format(columns, table)).fetchall())) for table, columns in compared_tables.items()])
+
+
+## Print the rows only one of the engines produced. Returns the number of
+## tables that differ.
+def compare(tables_by_engine, examples = 10):
+    differing = 0
+    for table in compared_tables:
+        first, second = [tables_by_engine[engine][table] for engine in engines]
+        only_first = sorted(first - second, key = repr)
+        only_second = sorted(second - first, key = repr)
+        print("{} {}: {} rows".format("ok  " if not (only_first or only_second) else "DIFF", table, len(first)), flush=True)
+        for engine, rows in zip(engines, [only_first, only_second]):
+            if rows:
+                print("\t{} rows only with the {} engine, e.g. {}".format(len(rows), engine, rows[:examples]), flush=True)
+        differing += bool(only_first or only_second)
+    return differing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check that the python and database snowball engines build the same graph")
+    parser.add_argument("admin_db_config_path")
+    parser.add_argument("--nodes", type = int, default = 2000, help = "subreddits in the fixture graph")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed for the graph")
+    parser.add_argument("--batch-size", type = int, default = 50, help = "subreddits per batch for the python engine")
+    parser.add_argument("--keep-db", action = "store_true", help = "don't drop the two databases")
+    args = parser.parse_args()
+
+    rows = fixture_rows(args.nodes, args.seed)
+    dbnames = dict([(engine, "snowball_parity_{}_{}".format(engine, os.getpid())) for engine in engines])
+    tables_by_engine = {}
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            for engine in engines:
+                engine_dir = os.path.join(config_dir, engine)
+                os.mkdir(engine_dir)
+                db_config_path = create_database(args.admin_db_config_path, dbnames[engine], engine_dir)
+                with connect(args.admin_db_config_path, dbnames[engine]) as conn:
+                    load_fixture(conn, rows, fixture_seeds(args.nodes))
+
+                print("Snowballing {} subreddits with the {} engine...".format(len(rows), engine), flush=True)
+                levels, elapsed = run_snowball(db_config_path, engine, args.batch_size)
+                print("{} engine: {} levels in {:.2f}s".format(engine, levels, elapsed), flush=True)
+
+                with connect(args.admin_db_config_path, dbnames[engine]) as conn:
+                    tables_by_engine[engine] = read_tables(conn)
+    finally:
+        if not args.keep_db:
+            for dbname in dbnames.values():
+                drop_database(args.admin_db_config_path, dbname)
+
+    differing = compare(tables_by_engine)
+    print("{} tables differ".format(differing) if differing else "Both engines built the same graph", flush=True)
+    sys.exit(1 if differing else 0)
@@ -0,0 +1,358 @@
+import prawcore
+
+import metrics
+from account_status import AccountStatusCache
+from backfill_metadata_text import backfill_complete_text
+from db_utils import execute_in_db, transaction, bulk_insert, enqueue_subreddits
+from metadata_fetcher import fetch_metadata_concurrently
+from reddit_json import update_metadata_sql, fetch_about, fetch_info, fetch_moderated, fetch_record
+from tie_extractor import Relation, extract_ties, extract_ties_in_db
+
+
+"""
+The snowball crawl shared by 2_hyperlink_tracing.py,
+3_shared_moderator_tracing.py and 4_unified_crawl.py.
+
+Each kind of tie keeps its own queue (its frontier): t1a_hyperlink_queue and
+t1b_reference_queue for the text relations (see tie_extractor.py) and
+t1c_moderator_queue for shared moderators. crawl() drives any combination of
+them from one work set:
+
+While any of the queues still has unprocessed subreddits:
+
+    1. Metadata Step: pull metadata (including moderators and rules) for every
+    subreddit in any of the queues that doesn't have it yet, once, however
+    many queues it's in (or, if the subreddit is private/no longer exists,
+    mark it unsuccessful). The about data comes from /api/info, 100
+    subreddits per request, and moderator accounts that no longer exist are
+    looked up in batches (account_status.py).
+
+    2. Snowball Step: extract the hyperlink and reference ties out of the
+    metadata text fields in one pass (tie_extractor.py), either in Python or,
+    with snowball_engine = "database", with a few set-based statements inside
+    the database
+
+    3. Moderator Step: pull the other subreddits moderated by each unprocessed
+    subreddit's moderators (each moderator at most once, see
+    moderator_cache.py) and add the shared moderator ties
+
+Each step adds newly discovered subreddits to the matching queue, and marks
+the processed subreddits as complete or unsuccessful in every queue it
+handled.
+
+API requests go through prawcore sessions and read the raw JSON (see
+reddit_json.py); `session_factory` should return a new one each call, e.g.
+reddit_api.init_reddit_session with a shared RateLimiter.
+
+Every step, scrape and metadata batch is timed, and the queue depth per step
+is recorded at the start of each round (see metrics.py).
+"""
+
+## Hyperlink and reference ties, extracted from the metadata text (the
+## prefixes are equivalent to the original regular expressions
+## "(reddit.com)/r/([A-Za-z0-9_-]+)" and
+## "(((^|\s)(/)?)|(reddit.com/))r/([A-Za-z0-9_-]+)")
+text_relations = [
+    Relation("hyperlink", "reddit.com/", "t1a_hyperlink_ties", "t1a_hyperlink_queue"),
+    Relation("reference", "(^|\\s)/?|reddit.com/", "t1b_reference_ties", "t1b_reference_queue"),
+]
+
+## /api/info takes up to 100 subreddit names per request
+info_batch_size = 100
+
+## Subreddit types whose /api/info data is complete
+viewable_subreddit_types = ["public", "restricted", "archived", "gold_only", "user"]
+
+moderator_queue = "t1c_moderator_queue"
+moderator_edges = "t1c_moderator_ties"
+
+## Which moderator accounts still exist, so deleted and suspended moderators
+## are dropped from the metadata rows (see account_status.py)
+account_status = AccountStatusCache()
+
+## The queue queries every round runs. They filter on the states the partial
+## indexes in 0_create_indexes.sql hold (unprocessed queue entries, subreddits
+## missing metadata or marked unsuccessful), so they cost the size of the
+## frontier rather than the size of the tables (check_query_plans.py checks
+## their plans)
+unprocessed_count_sql = """ SELECT COUNT(*) FROM {queue} WHERE processed = 0 """
+queue_depth_sql = """ SELECT step, COUNT(*) FROM {queue} WHERE processed = 0 GROUP BY step """
+unprocessed_queue_sql = """ SELECT subreddit, step FROM {queue} WHERE processed = 0 ORDER BY step, subreddit """
+mark_no_metadata_sql = """ UPDATE {queue} q SET processed = -1 WHERE q.processed = 0
+    AND EXISTS (SELECT 1 FROM t2_subreddit_metadata m WHERE m.subreddit = q.subreddit AND m.has_metadata = -1) """
+
+
+## Whether any subreddit unprocessed in one of the queues has metadata but no
+## complete_metadata_text (a row scraped before the crawler built it at ingest
+## time): one pass over the partial index of such rows (empty once they are
+## filled in), probing each queue's primary key
+def missing_text_sql(queue_tables):
+    return """ SELECT EXISTS (SELECT 1 FROM t2_subreddit_metadata m WHERE m.has_metadata = 1 AND m.complete_metadata_text IS NULL
+        AND ({})) """.format("\n            OR ".join(["EXISTS (SELECT 1 FROM {} q WHERE q.subreddit = m.subreddit AND q.processed = 0)".format(queue_table) for queue_table in queue_tables]))
+
+
+## The subreddits in any of the queues that don't have metadata yet: one pass
+## over the (small) set of subreddits missing metadata, probing each queue's
+## primary key. The EXISTS are OR'ed rather than one semi-join per queue, which
+## the planner turns into hash joins over the whole queues once the frontier
+## is a few thousand subreddits (1.4s instead of 50ms with 1M subreddits)
+def missing_metadata_sql(queue_tables):
+    return """ SELECT m.subreddit FROM t2_subreddit_metadata m WHERE m.has_metadata = 0
+        AND ({}) """.format("\n            OR ".join(["EXISTS (SELECT 1 FROM {} q WHERE q.subreddit = m.subreddit)".format(queue_table) for queue_table in queue_tables]))
+
+
+##########################
+## Reddit API functions ##
+##########################
+
+## Scrape metadata for a given subreddit name, including the subreddit's
+## moderators and rules. Returns a SubredditMetadata record, or None if the
+## subreddit can't be viewed.
+def scrape_subreddit_metadata(session, subreddit_name):
+    print("\tScraping {}...".format(subreddit_name), flush=True)
+
+    with metrics.timer("scrape_seconds", kind = "single"):
+        try:
+            about = fetch_about(session, subreddit_name)
+        except (prawcore.exceptions.NotFound, prawcore.exceptions.Forbidden, prawcore.exceptions.Redirect, prawcore.exceptions.BadRequest, prawcore.exceptions.ServerError, KeyError) as ex:
+            return
+
+        return fetch_subreddit_record(session, subreddit_name, about)
+
+
+## fetch_record() for a subreddit whose about data has been read, with any
+## error from its moderator, rules or account status requests (or a
+## malformed response) costing only this subreddit: it gets no record and is
+## marked unsuccessful, and the rest of its batch is kept
+def fetch_subreddit_record(session, subreddit_name, about):
+    try:
+        return fetch_record(session, subreddit_name, about, account_status = account_status)
+    except (prawcore.exceptions.ResponseException, KeyError, TypeError, AttributeError):
+        return
+
+
+## Scrape metadata for up to `info_batch_size` subreddits, with one /api/info
+## request for all of their about data (moderators and rules are still one
+## request each). Returns [(subreddit name, SubredditMetadata record)].
+##
+## Subreddits /api/info doesn't return don't exist (or are banned), so they get
+## no record and are marked unsuccessful, same as a 404 from /about.
+## Subreddits it returns but that can't be viewed (private, quarantined, ...)
+## go through scrape_subreddit_metadata() one at a time, so they are handled
+## exactly as before. If the /api/info request itself fails (an error status or
+## a malformed listing), the whole batch goes through it one at a time instead.
+def bulk_scrape_subreddit_metadata(session, subreddit_names):
+    print("\tScraping {} subreddits ({}...)...".format(len(subreddit_names), subreddit_names[0]), flush=True)
+    with metrics.timer("scrape_seconds", kind = "batch"):
+        return _bulk_scrape_subreddit_metadata(session, subreddit_names)
+
+
+def _bulk_scrape_subreddit_metadata(session, subreddit_names):
+    try:
+        found = fetch_info(session, subreddit_names)
+    except (prawcore.exceptions.NotFound, prawcore.exceptions.Forbidden, prawcore.exceptions.Redirect, prawcore.exceptions.BadRequest, prawcore.exceptions.ServerError, KeyError, TypeError, AttributeError) as ex:
+        found = None
+
+    results = []
+    for subreddit_name in subreddit_names:
+        if found is None:
+            results.append((subreddit_name, scrape_subreddit_metadata(session, subreddit_name)))
+            continue
+
+        about = found.get(subreddit_name.lower())
+        if about is None:
+            results.append((subreddit_name, None))
+        elif about.get("subreddit_type") not in viewable_subreddit_types or about.get("quarantine"):
+            results.append((subreddit_name, scrape_subreddit_metadata(session, subreddit_name)))
+        else:
+            results.append((subreddit_name, fetch_subreddit_record(session, subreddit_name, about)))
+
+    return results
+
+
+## Scrape the list of subreddits moderated by a given user
+def scrape_moderator_roles(session, username):
+    ## Make sure that user exists (i.e. check that account corresponding to username exists)
+    try:
+        return fetch_moderated(session, username)
+    except prawcore.exceptions.NotFound as ex:
+        return
+
+
+########################
+## Database functions ##
+########################
+
+
+## Insert a subreddit's metadata record into the database, along with its
+## complete_metadata_text and created_utc_ts (or mark the subreddit
+## unsuccessful if there is no record)
+def insert_subreddit_metadata_row(metadata_record, subreddit):
+    mark_unsuccessful_q = """ UPDATE t2_subreddit_metadata SET has_metadata = -1 WHERE subreddit = %s """
+
+    if metadata_record:
+        execute_in_db(update_metadata_sql, args = metadata_record.update_args())
+    else:
+        execute_in_db(mark_unsuccessful_q, args = [subreddit])
+
+
+## Insert a batch of (subreddit, metadata record) pairs in one transaction
+def insert_subreddit_metadata_rows(results):
+    with transaction():
+        for subreddit, metadata_record in results:
+            insert_subreddit_metadata_row(metadata_record, subreddit)
+    scraped = len([record for _, record in results if record])
+    metrics.increment("subreddits_scraped", scraped, outcome = "metadata")
+    metrics.increment("subreddits_scraped", len(results) - scraped, outcome = "unavailable")
+
+
+## Mark the queued subreddits that can't be processed (no metadata)
+def mark_no_metadata(queue_table):
+    execute_in_db(mark_no_metadata_sql.format(queue = queue_table))
+
+
+## Function to see if there are still unprocessed subreddits in the queue
+def check_num_unprocessed(queue_table):
+    unprocessed_count = execute_in_db(unprocessed_count_sql.format(queue = queue_table), return_first_only = True)[0]
+
+    return unprocessed_count
+
+
+## Record the number of unprocessed subreddits at each step of a queue
+def record_queue_depth(queue_table):
+    metrics.clear_gauges("queue_depth", queue = queue_table)
+    for step, count in execute_in_db(queue_depth_sql.format(queue = queue_table), return_results = True):
+        metrics.set_gauge("queue_depth", count, queue = queue_table, step = step)
+
+
+###########
+## Steps ##
+###########
+
+## Metadata Step: pull metadata for the subreddits in any of the queues that
+## don't have it yet (has_metadata = 0), `num_workers` at a time, writing each
+## batch to the database as it comes in
+def metadata_step(session_factory, queue_tables, num_workers = 8):
+    queue = execute_in_db(missing_metadata_sql(queue_tables), return_first_only = True)
+    print("{} subreddits to pull metadata".format(len(queue)), flush = True)
+
+    ## Each worker pulls one /api/info batch at a time, and each batch is
+    ## written as soon as it comes back
+    batches = [tuple(queue[start:start + info_batch_size]) for start in range(0, len(queue), info_batch_size)]
+
+    def write_batches(results):
+        insert_subreddit_metadata_rows([pair for _, batch_results in results for pair in batch_results])
+
+    fetch_metadata_concurrently(batches, bulk_scrape_subreddit_metadata, session_factory, write_batches, num_workers = num_workers, batch_size = 1)
+
+
+## Snowball Step: extract every text relation's edges from the unprocessed
+## subreddits, one scan per subreddit. With `engine` "database" the whole
+## level is handled inside the database (see tie_extractor.extract_ties_in_db)
+## and `extractor` only supplies the relations; otherwise the level is
+## streamed through `extractor` `batch_size` subreddits at a time.
+def snowball_step(extractor, engine = "python", batch_size = 2000):
+    for relation in extractor.relations:
+        mark_no_metadata(relation.queue_table)
+    fill_missing_text([relation.queue_table for relation in extractor.relations])
+
+    if engine == "database":
+        processed, edge_counts = extract_ties_in_db(extractor.relations)
+    else:
+        processed, edge_counts = extract_ties(extractor, batch_size = batch_size)
+    print("{} rows processed, {} edges found".format(processed, sum(edge_counts)), flush = True)
+
+
+## Rows scraped before complete_metadata_text was built at ingest time would
+## be read as empty text (no ties, but marked processed), so if the frontier has
+## any, fill in every missing text first (backfill_metadata_text.py)
+def fill_missing_text(queue_tables):
+    if execute_in_db(missing_text_sql(queue_tables), return_first_only = True)[0]:
+        print("Queued subreddits without complete_metadata_text (scraped by an older crawl); filling it in...", flush = True)
+        print("{} complete texts written.".format(backfill_complete_text()), flush = True)
+
+
+## Moderator Step: add the shared moderator ties of every unprocessed subreddit
+## in the moderator queue, `batch_size` subreddits at a time
+def moderator_step(session, moderator_cache, batch_size = 500):
+    get_moderators_sql = """ SELECT subreddit, moderators, has_moderator_metadata FROM t2_subreddit_metadata WHERE subreddit = ANY(%s) AND has_metadata = 1 """
+    set_sub_moderator_metadata_sql = """ UPDATE t2_subreddit_metadata SET has_moderator_metadata = 1 WHERE subreddit = ANY(%s) """
+    set_processed_sql = """ UPDATE {} SET processed = 1 WHERE subreddit = ANY(%s) """.format(moderator_queue)
+
+    mark_no_metadata(moderator_queue)
+
+    queue = execute_in_db(unprocessed_queue_sql.format(queue = moderator_queue), return_results = True)
+    print("{} subreddits to process moderator ties".format(len(queue)), flush = True)
+
+    for start in range(0, len(queue), batch_size):
+        batch = queue[start:start + batch_size]
+        steps = dict(batch)
+        moderators = {}
+        needs_roles = []
+        for subreddit, subreddit_moderators, has_moderator_metadata in execute_in_db(get_moderators_sql, return_results = True, args = [list(steps)]):
+            moderators[subreddit] = [moderator for moderator in (subreddit_moderators or []) if moderator]
+            if has_moderator_metadata == 0:
+                needs_roles.append(subreddit)
+
+        ## Scrape the moderation roles that aren't in the database yet, and
+        ## read the rest in one query
+        moderator_cache.ensure(session, [moderator for subreddit in needs_roles for moderator in moderators[subreddit]])
+        moderator_cache.preload([moderator for subreddit_moderators in moderators.values() for moderator in subreddit_moderators])
+
+        ## Shared moderator ties, and the lowest step each newly found subreddit
+        ## is reached from
+        shared_moderator_ties = set()
+        frontier = {}
+        for subreddit, subreddit_moderators in moderators.items():
+            for moderator in subreddit_moderators:
+                for moderated_subreddit in moderator_cache.get(moderator) or []:
+                    if moderated_subreddit != subreddit:
+                        shared_moderator_ties.add((subreddit, moderated_subreddit, moderator))
+                        if moderated_subreddit not in frontier or steps[subreddit] + 1 < frontier[moderated_subreddit]:
+                            frontier[moderated_subreddit] = steps[subreddit] + 1
+
+        targets_by_step = {}
+        for target, step in frontier.items():
+            targets_by_step.setdefault(step, []).append(target)
+
+        with transaction():
+            for step in sorted(targets_by_step):
+                enqueue_subreddits(targets_by_step[step], moderator_queue, step)
+            if shared_moderator_ties:
+                metrics.increment("ties_found", bulk_insert(moderator_edges, ["source", "target", "label"], sorted(shared_moderator_ties)), relation = "moderator")
+            if needs_roles:
+                execute_in_db(set_sub_moderator_metadata_sql, args = [needs_roles])
+            execute_in_db(set_processed_sql, args = [list(moderators)])
+
+        print("\t{} subreddits processed, {} moderator ties found".format(min(start + batch_size, len(queue)), len(shared_moderator_ties)), flush = True)
+
+
+## Snowball every given frontier until none has unprocessed subreddits left:
+## `extractor` (a TieExtractor) for the text relations, and `moderator_cache`
+## (a ModeratorRoleCache built with scrape_moderator_roles) for shared
+## moderators. Every subreddit's metadata is pulled once, whichever frontiers
+## it's in. `snowball_engine` is passed on to snowball_step().
+def crawl(session_factory, extractor = None, moderator_cache = None, metadata_workers = 8, snowball_engine = "python"):
+    queue_tables = []
+    if extractor is not None:
+        queue_tables.extend([relation.queue_table for relation in extractor.relations])
+    if moderator_cache is not None:
+        queue_tables.append(moderator_queue)
+        session = session_factory()
+
+    while sum([check_num_unprocessed(queue_table) for queue_table in queue_tables]) > 0:
+        print("Snowballing...", flush=True)
+        for queue_table in queue_tables:
+            record_queue_depth(queue_table)
+        with metrics.timer("step_seconds", step = "metadata"):
+            metadata_step(session_factory, queue_tables, num_workers = metadata_workers)
+        if extractor is not None:
+            with metrics.timer("step_seconds", step = "snowball"):
+                snowball_step(extractor, engine = snowball_engine)
+        if moderator_cache is not None:
+            with metrics.timer("step_seconds", step = "moderator"):
+                moderator_step(session, moderator_cache)
+
+    account_status.print_stats()
+    if moderator_cache is not None:
+        moderator_cache.print_stats()
@@ -0,0 +1,198 @@
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from psycopg_pool import ConnectionPool
+
+import metrics
+
+
+"""
+Shared database access for the collection scripts.
+
+Call init_db() once at startup with the path to a text file in the following
+format:
+
+host='database_host'
+dbname='database_name'
+user='username'
+password='password'
+
+The config is parsed once and a connection pool is kept open for the rest of
+the run, so each query borrows an already-open connection instead of
+connecting from scratch. Wrap a group of statements in `with transaction():`
+to run them on one connection and commit them together; outside of a
+transaction block every call to execute_in_db() commits on its own, as before.
+
+Use bulk_insert() rather than a batch_insert INSERT for anything bigger than a
+handful of rows: it streams the rows with COPY and skips rows that already
+exist (ON CONFLICT DO NOTHING).
+
+stream_query() reads a large result set batch by batch with a server-side
+cursor.
+
+Per-query latency is accumulated in `query_stats` and can be printed with
+print_query_stats(); it also goes to the db_query_seconds metric (metrics.py).
+"""
+
+pool = None
+
+## Connection (and cursor) used by an open transaction() block, per thread
+_local = threading.local()
+
+## {first line of query: [call count, total seconds]}
+query_stats = {}
+_stats_lock = threading.Lock()
+
+
+## Read the db config file and open the connection pool
+def init_db(db_config_path, min_size = 1, max_size = 4):
+    global pool
+    with open(db_config_path) as f:
+        conn_str = " ".join([l.strip() for l in f.readlines()])
+    ## check_connection makes sure a connection that sat idle during a long
+    ## stretch of API calls is still alive before it's handed out
+    pool = ConnectionPool(conn_str, min_size = min_size, max_size = max_size, check = ConnectionPool.check_connection, open = True)
+    return pool
+
+
+## Close the connection pool (and print the latency counters)
+def close_db(print_stats = True):
+    global pool
+    if print_stats:
+        print_query_stats()
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+## Run a group of statements on one connection, committing once at the end
+## (or rolling back if anything raises). Nested blocks reuse the outer one.
+@contextmanager
+def transaction():
+    if getattr(_local, "cursor", None) is not None:
+        yield _local.cursor
+        return
+
+    with pool.connection() as conn:
+        with conn.transaction():
+            with conn.cursor() as cursor:
+                _local.cursor = cursor
+                try:
+                    yield cursor
+                finally:
+                    _local.cursor = None
+
+
+def _record_query_time(query, elapsed):
+    key = " ".join(query.split())[:80]
+    with _stats_lock:
+        stats = query_stats.setdefault(key, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+    metrics.observe("db_query_seconds", elapsed, statement = key)
+
+
+## Print call counts and latency per query, slowest total first
+def print_query_stats():
+    with _stats_lock:
+        rows = sorted(query_stats.items(), key = lambda item: item[1][1], reverse = True)
+    total_calls = sum([stats[0] for _, stats in rows])
+    total_time = sum([stats[1] for _, stats in rows])
+    print("{} queries in {:.1f}s".format(total_calls, total_time), flush=True)
+    for query, (count, elapsed) in rows:
+        print("\t{:>8} calls {:>9.2f}s total {:>8.2f}ms avg\t{}".format(count, elapsed, elapsed * 1000 / count, query), flush=True)
+
+
+## Execute single query and return results
+def execute_in_db(query, return_results = False, return_first_only = False, args = None, batch_insert = False):
+    with transaction() as cursor:
+        start = perf_counter()
+
+        if args and batch_insert:
+            ## executemany pipelines the statements instead of waiting on
+            ## one round trip per row
+            cursor.executemany(query, args)
+        elif args:
+            cursor.execute(query, args)
+        else:
+            cursor.execute(query)
+
+        if return_first_only:
+            results = [row[0] for row in cursor.fetchall()]
+        elif return_results:
+            results = cursor.fetchall()
+        else:
+            results = None
+
+        _record_query_time(query, perf_counter() - start)
+
+    return results
+
+
+## Stream the results of a query in lists of up to `batch_size` rows through a
+## server-side cursor, so the whole result never has to fit in memory. The
+## cursor gets its own pooled connection (outside of any transaction() block),
+## so the caller can keep writing with execute_in_db()/bulk_insert() between
+## batches.
+def stream_query(query, args = None, batch_size = 2000):
+    with pool.connection() as conn:
+        with conn.cursor(name = "stream_query") as cursor:
+            start = perf_counter()
+            cursor.execute(query, args)
+            _record_query_time(query, perf_counter() - start)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+
+## Insert many rows with one COPY per batch, skipping rows that would violate
+## a unique constraint (ON CONFLICT DO NOTHING). The rows are copied into a temp
+## staging table shaped like `table` and moved over with one INSERT ... SELECT.
+## Returns the number of rows that were actually inserted.
+def bulk_insert(table, columns, rows, page_size = 50000):
+    column_list = ", ".join(columns)
+    staging_table = "staging_{}".format(table)
+    create_staging_q = """ CREATE TEMP TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS) """.format(staging_table, table)
+    truncate_staging_q = """ TRUNCATE {} """.format(staging_table)
+    copy_q = """ COPY {} ({}) FROM STDIN """.format(staging_table, column_list)
+    insert_q = """ INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING """.format(table, column_list, column_list, staging_table)
+
+    inserted = 0
+    rows = iter(rows)
+    with transaction() as cursor:
+        while True:
+            page = [row for _, row in zip(range(page_size), rows)]
+            if not page:
+                break
+
+            start = perf_counter()
+            cursor.execute(create_staging_q)
+            cursor.execute(truncate_staging_q)
+            with cursor.copy(copy_q) as copy:
+                for row in page:
+                    copy.write_row(row)
+            cursor.execute(insert_q)
+            inserted += cursor.rowcount
+            _record_query_time(insert_q, perf_counter() - start)
+
+    return inserted
+
+
+## Add newly discovered subreddits to the metadata table (as has_metadata = 0
+## stubs) and to a processing queue at the given step. Subreddits that are
+## already in either table are skipped by the database (ON CONFLICT DO NOTHING),
+## so the cost depends on the number of subreddits passed in, not on the size
+## of the tables. Returns the number of subreddits newly added to the queue.
+def enqueue_subreddits(subreddits, queue_table, step):
+    subreddits = sorted(set([subreddit.lower() for subreddit in subreddits if subreddit]))
+    if not subreddits:
+        return 0
+
+    with transaction():
+        bulk_insert("t2_subreddit_metadata", ["subreddit", "has_metadata"], [(subreddit, 0) for subreddit in subreddits])
+        added = bulk_insert(queue_table, ["subreddit", "step"], [(subreddit, step) for subreddit in subreddits])
+    metrics.increment("subreddits_enqueued", added, queue = queue_table)
+    return added
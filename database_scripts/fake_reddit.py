@@ -0,0 +1,348 @@
+import argparse
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlsplit, parse_qs
+
+from cassette import load_cassette, request_key
+
+
+"""
+A local stand-in for the parts of the Reddit API the collection scripts use,
+so the metadata fetchers can be run (and timed) without live credentials.
+
+The data comes from a fixture file in the following format:
+
+{
+    "subreddits": {
+        "dogs": {
+            "status": 200,                  (403 for private, 404 for missing)
+            "about": {"display_name": "dogs", "title": ..., ...},
+            "moderators": ["some_user", ...],
+            "rules": [{"short_name": ..., "description": ...}, ...]
+        }, ...
+    },
+    "users": {
+        "some_user": {"created_utc": 1234567890.0, "moderated": ["dogs", ...]}, ...
+    },
+    "search": {
+        "some keyword": ["dogs", ...], ...
+    }
+}
+
+Users that aren't in "users" get a 404, like a deleted/suspended account.
+Subreddit search (/subreddits/search.json) returns the subreddits listed for
+the keyword in "search", or else every subreddit whose name, title or
+description contains it, paged with `limit` and `after` like the real thing.
+/api/info answers batch lookups (`sr_name=a,b,c`) for the subreddits in the
+fixture, and /api/user_data_by_account_ids (`ids=t2_a,t2_b`) returns the
+accounts in "users" (moderators' fullnames are t2_USERNAME). To use the search, set keyword_search.search_endpoint to
+http://127.0.0.1:8765/subreddits/search.json
+
+It can also replay a cassette recorded from a live run (cassette.py): each
+request that was recorded gets the recorded response back, and anything else
+falls through to the fixture (which can be left out), so a whole collection
+run can be repeated offline.
+
+To make timings realistic, every response can be delayed (`--latency-ms`
+plus up to `--jitter-ms` at random, or `--recorded-latency` to wait as long
+as the live request took), and the server can enforce a request budget like
+Reddit's: `--rate-limit N` requests per `--rate-window` seconds, reported in
+the X-Ratelimit-Used/Remaining/Reset headers, with a 429 and Retry-After once
+the window is used up.
+
+To point PRAW at it, add these lines to the reddit config file:
+
+oauth_url=http://127.0.0.1:8765
+reddit_url=http://127.0.0.1:8765
+
+Run with: python fake_reddit.py fixture.json --port 8765
+      or: python fake_reddit.py --cassette run.jsonl.gz --recorded-latency --rate-limit 600
+"""
+
+
+## Reddit-style request budget: `limit` requests per `window` seconds, shared
+## by every client of the server
+class RateLimitSimulator:
+
+    def __init__(self, limit, window = 600.0):
+        self.limit = limit
+        self.window = window
+        self.window_start = monotonic()
+        self.used = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    ## Count a request. Returns (allowed, rate limit headers).
+    def take(self):
+        with self.lock:
+            now = monotonic()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.used = 0
+            reset = self.window - (now - self.window_start)
+            allowed = self.used < self.limit
+            if allowed:
+                self.used += 1
+            else:
+                self.rejected += 1
+            headers = {
+                "X-Ratelimit-Used": str(self.used),
+                "X-Ratelimit-Remaining": str(float(self.limit - self.used)),
+                "X-Ratelimit-Reset": str(int(reset)),
+            }
+            if not allowed:
+                headers["Retry-After"] = str(int(reset) + 1)
+        return allowed, headers
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+
+    ## Keep connections open between requests, like the real API (every
+    ## response has a Content-Length), and send the headers and body without
+    ## waiting on Nagle's algorithm
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    ## (path regex, handler method name)
+    routes = [
+        (re.compile(r"^/api/v1/access_token$"), "access_token"),
+        (re.compile(r"^/r/([^/]+)/about$"), "subreddit_about"),
+        (re.compile(r"^/r/([^/]+)/about/moderators$"), "subreddit_moderators"),
+        (re.compile(r"^/r/([^/]+)/about/rules$"), "subreddit_rules"),
+        (re.compile(r"^/user/([^/]+)/about$"), "user_about"),
+        (re.compile(r"^/user/([^/]+)/moderated_subreddits$"), "user_moderated"),
+        (re.compile(r"^/subreddits/search(?:\.json)?$"), "subreddit_search"),
+        (re.compile(r"^/api/info(?:\.json)?$"), "info"),
+        (re.compile(r"^/api/user_data_by_account_ids(?:\.json)?$"), "user_data_by_account_ids"),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        self.send_content(status, json.dumps(body).encode("utf-8"))
+
+    def send_content(self, status, content):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in self.extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def route(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        self.query = parse_qs(url.query)
+        self.extra_headers = {}
+
+        ## The token exchange is free and instant; everything else counts
+        ## against the rate limit and is delayed
+        if path == "/api/v1/access_token":
+            return self.access_token()
+
+        recorded = self.server.exchanges.get(request_key(self.command, self.path))
+        self.delay(recorded[2] if recorded else None)
+        if self.server.rate_limit is not None:
+            allowed, self.extra_headers = self.server.rate_limit.take()
+            if not allowed:
+                return self.send_json(429, {"message": "Too Many Requests", "error": 429})
+
+        if recorded:
+            return self.send_content(recorded[0], recorded[1].encode("utf-8"))
+        for pattern, handler_name in self.routes:
+            match = pattern.match(path)
+            if match:
+                return getattr(self, handler_name)(*match.groups())
+        self.send_json(404, {"message": "Not Found", "error": 404})
+
+    ## Simulated network latency (`recorded_elapsed` is how long the live
+    ## request took, for a replayed one)
+    def delay(self, recorded_elapsed = None):
+        if self.server.recorded_latency and recorded_elapsed is not None:
+            seconds = recorded_elapsed
+        else:
+            seconds = (self.server.latency_ms + random.uniform(0, self.server.jitter_ms)) / 1000.0
+        if seconds > 0:
+            sleep(seconds)
+
+    def do_GET(self):
+        self.route()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.route()
+
+    ## The about data for a subreddit, filled in with the fields search results
+    ## and listings always have
+    def subreddit_data(self, name):
+        about = dict(self.server.fixture["subreddits"].get(name, {}).get("about", {}))
+        about.setdefault("display_name", name)
+        about.setdefault("name", "t5_{}".format(name))
+        about.setdefault("title", None)
+        about.setdefault("description", None)
+        about.setdefault("public_description", None)
+        about.setdefault("url", "/r/{}/".format(name))
+        about.setdefault("subreddit_type", "public")
+        return about
+
+    ## Look up a subreddit, sending the error response if it can't be viewed
+    def get_subreddit(self, name):
+        subreddit = self.server.fixture["subreddits"].get(name.lower())
+        if subreddit is None:
+            self.send_json(404, {"message": "Not Found", "error": 404, "reason": "banned"})
+            return
+        if subreddit.get("status", 200) == 403:
+            self.send_json(403, {"message": "Forbidden", "error": 403, "reason": "private"})
+            return
+        return subreddit
+
+    def access_token(self):
+        self.send_json(200, {"access_token": "fake-token", "token_type": "bearer", "expires_in": 86400, "scope": "*"})
+
+    def subreddit_about(self, name):
+        subreddit = self.get_subreddit(name)
+        if subreddit is not None:
+            self.send_json(200, {"kind": "t5", "data": self.subreddit_data(name.lower())})
+
+    def subreddit_moderators(self, name):
+        subreddit = self.get_subreddit(name)
+        if subreddit is not None:
+            children = [{"name": username, "id": "t2_{}".format(username), "mod_permissions": ["all"], "date": 0.0} for username in subreddit.get("moderators", [])]
+            self.send_json(200, {"kind": "UserList", "data": {"children": children}})
+
+    def subreddit_rules(self, name):
+        subreddit = self.get_subreddit(name)
+        if subreddit is not None:
+            self.send_json(200, {"rules": subreddit.get("rules", []), "site_rules": [], "site_rules_flow": []})
+
+    def user_about(self, username):
+        user = self.server.fixture["users"].get(username)
+        if user is None:
+            self.send_json(404, {"message": "Not Found", "error": 404})
+            return
+        self.send_json(200, {"kind": "t2", "data": {"name": username, "id": username, "created_utc": user.get("created_utc", 0.0)}})
+
+    def user_moderated(self, username):
+        user = self.server.fixture["users"].get(username)
+        if user is None:
+            self.send_json(404, {"message": "Not Found", "error": 404})
+            return
+        moderated = [{"sr": name, "display_name": name, "sr_display_name_prefixed": "r/{}".format(name)} for name in user.get("moderated", [])]
+        self.send_json(200, {"kind": "ModeratedList", "data": moderated})
+
+    def subreddit_search(self):
+        keyword = self.query.get("q", [""])[0]
+        limit = int(self.query.get("limit", ["25"])[0])
+        after = self.query.get("after", [None])[0]
+
+        names = self.server.fixture["search"].get(keyword)
+        if names is None:
+            names = []
+            for name in sorted(self.server.fixture["subreddits"]):
+                about = self.subreddit_data(name)
+                text = " ".join([str(about.get(key) or "") for key in ["display_name", "title", "public_description"]])
+                if keyword.lower() in text.lower():
+                    names.append(name)
+
+        results = [self.subreddit_data(name) for name in names]
+        start = 0
+        if after:
+            fullnames = [about["name"] for about in results]
+            start = fullnames.index(after) + 1 if after in fullnames else len(results)
+        page = results[start:start + limit]
+        next_after = page[-1]["name"] if page and start + limit < len(results) else None
+        self.send_json(200, {"kind": "Listing", "data": {"after": next_after, "children": [{"kind": "t5", "data": about} for about in page]}})
+
+    ## Batch about data: up to 100 names in `sr_name` (or t5_ fullnames in
+    ## `id`), comma separated. Missing subreddits are left out and private
+    ## ones only get their name and type, like the real endpoint.
+    def info(self):
+        names = []
+        for value in self.query.get("sr_name", []):
+            names.extend([name.lower() for name in value.split(",") if name])
+        for value in self.query.get("id", []):
+            names.extend([fullname[3:].lower() for fullname in value.split(",") if fullname.startswith("t5_")])
+        if len(names) > 100:
+            self.send_json(400, {"message": "Bad Request", "error": 400})
+            return
+
+        children = []
+        for name in names:
+            subreddit = self.server.fixture["subreddits"].get(name)
+            if subreddit is None:
+                continue
+            if subreddit.get("status", 200) == 403:
+                children.append({"kind": "t5", "data": {"display_name": name, "name": "t5_{}".format(name), "subreddit_type": "private"}})
+            else:
+                children.append({"kind": "t5", "data": self.subreddit_data(name)})
+        self.send_json(200, {"kind": "Listing", "data": {"after": None, "children": children}})
+
+    ## {fullname: user data} for the t2_ fullnames in `ids` whose accounts
+    ## exist (missing accounts are left out)
+    def user_data_by_account_ids(self):
+        users = {}
+        for value in self.query.get("ids", []):
+            for fullname in value.split(","):
+                user = self.server.fixture["users"].get(fullname[3:]) if fullname.startswith("t2_") else None
+                if user is not None:
+                    users[fullname] = {"name": fullname[3:], "created_utc": user.get("created_utc", 0.0)}
+        self.send_json(200, users)
+
+
+## Start the server on a background thread and return it (call
+## server.shutdown() when done). Port 0 picks a free port; the one picked is
+## in server.server_address. `exchanges` are the recorded responses to replay
+## (see cassette.load_cassette) and `rate_limit` a RateLimitSimulator.
+def serve_fixture(fixture, host = "127.0.0.1", port = 0, exchanges = None, latency_ms = 0.0, jitter_ms = 0.0, recorded_latency = False, rate_limit = None):
+    server = ThreadingHTTPServer((host, port), FakeRedditHandler)
+    server.daemon_threads = True
+    server.fixture = {"subreddits": fixture.get("subreddits", {}), "users": fixture.get("users", {}), "search": fixture.get("search", {})}
+    server.exchanges = exchanges or {}
+    server.latency_ms = latency_ms
+    server.jitter_ms = jitter_ms
+    server.recorded_latency = recorded_latency
+    server.rate_limit = rate_limit
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve a fixture file (and/or a recorded cassette) as a fake Reddit API")
+    parser.add_argument("fixture_path", nargs = "?")
+    parser.add_argument("--cassette", help = "cassette file to replay (see cassette.py)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--latency-ms", type = float, default = 0.0, help = "delay before every response")
+    parser.add_argument("--jitter-ms", type = float, default = 0.0, help = "extra random delay, up to this much")
+    parser.add_argument("--recorded-latency", action = "store_true", help = "delay replayed responses as long as the live requests took")
+    parser.add_argument("--rate-limit", type = int, help = "requests allowed per rate window (no limit by default)")
+    parser.add_argument("--rate-window", type = float, default = 600.0, help = "rate window length in seconds")
+    args = parser.parse_args()
+
+    if not args.fixture_path and not args.cassette:
+        parser.error("need a fixture file, a cassette, or both")
+
+    fixture = {}
+    if args.fixture_path:
+        with open(args.fixture_path) as f:
+            fixture = json.load(f)
+    exchanges = load_cassette(args.cassette) if args.cassette else {}
+    rate_limit = RateLimitSimulator(args.rate_limit, args.rate_window) if args.rate_limit else None
+
+    server = serve_fixture(fixture, host = args.host, port = args.port, exchanges = exchanges, latency_ms = args.latency_ms,
+        jitter_ms = args.jitter_ms, recorded_latency = args.recorded_latency, rate_limit = rate_limit)
+    print("Serving fake Reddit API on http://{}:{} ({} recorded exchanges)".format(server.server_address[0], server.server_address[1], len(exchanges)), flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        if rate_limit:
+            print("{} requests rejected by the rate limit".format(rate_limit.rejected), flush=True)
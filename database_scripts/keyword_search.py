@@ -0,0 +1,199 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from rate_limiter import RateLimiter
+from response_cache import CachedSession
+
+
+"""
+Subreddit keyword search shared by 1_collect_seeds_by_keywords.py and
+seed_subreddits/pull_seeds.py.
+
+search_keywords() pages through the search results for several keywords at
+once (`num_workers` keyword cursors in flight), over one pooled
+requests.Session so each worker reuses its TCP/TLS connection, with every
+request taking a permit from one shared RateLimiter. Each page of extracted
+rows is passed to on_rows(keyword, rows) as soon as it arrives. on_rows is
+called from the worker threads, but never concurrently (calls are serialized
+with a lock), so it can append to a list or write to a file directly.
+
+Each row has the following fields in order:
+    (1) search keyword,
+    (2) subreddit name (i.e. r/something),
+    (3) subreddit id (i.e. a string starting with t_),
+    (4) subreddit title,
+    (5) subreddit description as shown in the search results page,
+    (6) a link to the subreddit, and
+    (7) the concatenation of the description and title (for easier text searching/matching).
+    Note: Some fields may be empty if the subreddit is private or otherwise not publicly visible.
+
+Pass a SearchCheckpoint (search_checkpoint.py) to save each page and the
+cursor after it once on_rows has taken the page; a rerun with the same
+checkpoint file continues every keyword where it stopped instead of starting
+over. With a checkpoint, on_rows is only passed the rows the checkpoint
+didn't have yet (one per (keyword, subreddit)), so it doesn't need to dedup
+them itself (a page on_rows took just before a crash may be passed again).
+
+Pass a ResponseCache (response_cache.py) to answer pages searched within its
+time to live from disk; only the pages that aren't cached take a rate limit
+permit. Pass a Cassette (cassette.py) to record every search page for an
+offline replay by fake_reddit.py.
+
+Set `search_endpoint` to a fake_reddit.py server's /subreddits/search.json
+to run against a local fixture.
+"""
+
+search_endpoint = "https://www.reddit.com/subreddits/search.json"
+search_headers = {"User-agent": "com.lgs17.searching_subreddits"}
+
+
+def pull_keywords():
+    keywords = ["red pill", "redpill", "trp", "blue pill", "bluepill", "manosphere", "mra", "men's rights movement", "men's rights activists", "mgtow", "mghow", "men going their own way", "mgtower", "pua", "pickup artist", "pick-up artist", "feminism", "feminist", "misandry", "genderqueer", "trans", "ftm", "mtf", "transgender", "transsexual", "non-binary", "enby", "nonbinary", "chad", "stacy", "becky", "foid", "femoid", "alpha", "beta", "zeta", "incel"]
+    return keywords
+
+
+def extract_subreddits_from_json(result, keyword):
+
+    extracted_subreddits = []
+    subreddits = result["data"]["children"]
+
+    for sub_json in subreddits:
+
+        subreddit = sub_json["data"]["display_name"]
+        subreddit_title = sub_json["data"]["title"]
+        description = sub_json["data"]["description"]
+        link = "https://www.reddit.com/{}".format(sub_json["data"]["url"])
+        subreddit_id = sub_json["data"]["name"]
+        searched_text = " ".join([elt for elt in [subreddit_title, description] if elt])
+
+        row = (keyword, subreddit.lower(), subreddit_id, subreddit_title, description, link, searched_text)
+        extracted_subreddits.append(row)
+
+    return extracted_subreddits
+
+
+## A requests.Session whose connection pool fits `num_workers` concurrent
+## requests to the same host (a CachedSession that takes the permits from
+## `rate_limiter` itself, if there's a `cache`), recording to `cassette` if
+## there is one
+def make_session(num_workers, cache = None, rate_limiter = None, cassette = None):
+    session = CachedSession(cache, rate_limiter = rate_limiter) if cache else requests.Session()
+    if cassette:
+        cassette.attach(session)
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = num_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(search_headers)
+    return session
+
+
+## Page through the search results for one keyword, passing each page of
+## rows to on_rows(keyword, rows). Returns the number of rows collected
+## (including any collected by earlier runs, when resuming from `checkpoint`).
+def search_keyword(session, rate_limiter, keyword, on_rows, checkpoint = None):
+
+    start_after_id, done, row_count = (None, False, 0)
+    if checkpoint:
+        start_after_id, done, row_count = checkpoint.resume_state(keyword)
+        if done:
+            print("\t\tAlready collected {}.... {} rows.".format(keyword, row_count), flush=True)
+            return row_count
+        if start_after_id:
+            print("\t\tResuming {} after {}.... {} rows so far.".format(keyword, start_after_id, row_count), flush=True)
+
+    failed = False
+
+    def make_request(after_id=None):
+        nonlocal row_count, failed
+
+        search_params = {
+            "q": keyword,
+            "include_over_18": "on",
+            "limit": 100,
+            "show": "all",
+            "raw_json": 1
+        }
+
+        if after_id:
+            search_params["after"] = after_id
+
+        if isinstance(session, CachedSession):
+            result = session.get(search_endpoint, params = search_params)
+        else:
+            result = rate_limiter.call(lambda: session.get(search_endpoint, params = search_params))
+        metrics.observe_response(result)
+
+        if result.ok:
+            page_results = extract_subreddits_from_json(result.json(), keyword)
+            last_id = page_results[-1][2] if bool(page_results) else None
+            if len(page_results) == 0:
+                return None
+
+            if last_id != after_id:
+                ## Hand the rows on before the checkpoint moves past the page:
+                ## if on_rows fails (or the run dies in between), a resumed run
+                ## fetches the page again. With a checkpoint, only the rows it
+                ## didn't have yet are handed on.
+                if checkpoint:
+                    checkpoint.save_page(keyword, page_results, last_id, on_new_rows = lambda rows: on_rows(keyword, rows))
+                else:
+                    on_rows(keyword, page_results)
+                row_count += len(page_results)
+
+            return last_id
+
+        else:
+            print("\tBad response for {}: {}".format(keyword, str(result)), flush=True)
+            failed = True
+            return
+
+
+    new_after_id, after_id = make_request(after_id=start_after_id), ""
+    request_count = 0
+
+    while bool(new_after_id):
+        after_id = new_after_id
+        new_after_id = make_request(after_id=new_after_id)
+
+        request_count = request_count + 1
+
+        if (request_count % 60 == 0) or not bool(new_after_id):
+            print("\t\tCurrently collecting {}.... Request count #{}.... {} rows collected.".format(keyword, request_count, row_count), flush=True)
+
+        ## There are not enough results for a new iteration, so we're getting duplicates of the first results
+        if new_after_id == after_id:
+            new_after_id = None
+
+    ## A keyword that stopped on a bad response is left unfinished, so the
+    ## next run picks it up from the last saved cursor
+    if checkpoint and not failed:
+        checkpoint.mark_done(keyword)
+
+    return row_count
+
+
+## Search all the keywords, `num_workers` at a time. Returns {keyword: number of
+## rows collected}.
+def search_keywords(keywords, on_rows, num_workers = 4, rate_limiter = None, checkpoint = None, cache = None, cassette = None):
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(requests_per_minute = 60, name = "subreddit search")
+    session = make_session(num_workers, cache = cache, rate_limiter = rate_limiter, cassette = cassette)
+    on_rows_lock = threading.Lock()
+
+    def locked_on_rows(keyword, rows):
+        with on_rows_lock:
+            on_rows(keyword, rows)
+
+    def search(keyword):
+        print("CURRENT KEYWORD:\t{}".format(keyword), flush=True)
+        return search_keyword(session, rate_limiter, keyword, locked_on_rows, checkpoint = checkpoint)
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        row_counts = dict(zip(keywords, executor.map(search, keywords)))
+
+    session.close()
+    return row_counts
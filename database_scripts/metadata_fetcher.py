@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+"""
+Bounded-concurrency subreddit metadata fetching.
+
+fetch_metadata_concurrently() keeps up to `num_workers` scrapes in flight.
+PRAW objects and prawcore sessions aren't thread safe, so every worker thread
+builds its own with reddit_factory(); pass a factory that shares one
+RateLimiter (see reddit_api.init_reddit and init_reddit_session) so all of the
+threads together stay inside the API request budget. Finished (subreddit,
+metadata_row) pairs are handed to write_batch() in groups of `batch_size` as
+they complete, so the database writes happen while the next requests are
+still in flight.
+"""
+
+
+def fetch_metadata_concurrently(subreddit_names, scrape, reddit_factory, write_batch, num_workers = 8, batch_size = 50):
+    local = threading.local()
+
+    def fetch(subreddit_name):
+        if not hasattr(local, "reddit"):
+            local.reddit = reddit_factory()
+        return (subreddit_name, scrape(local.reddit, subreddit_name))
+
+    subreddit_names = iter(subreddit_names)
+    in_flight = set()
+    batch = []
+    fetched = 0
+
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        try:
+            while True:
+                ## Top the pool back up to `num_workers` outstanding requests
+                ## (twice that, so a worker never waits on the main thread)
+                for subreddit_name in subreddit_names:
+                    in_flight.add(executor.submit(fetch, subreddit_name))
+                    if len(in_flight) >= num_workers * 2:
+                        break
+
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when = FIRST_COMPLETED)
+                for future in done:
+                    batch.append(future.result())
+
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    fetched += len(batch)
+                    batch = []
+        finally:
+            ## Keep whatever finished before an error
+            if batch:
+                write_batch(batch)
+                fetched += len(batch)
+            for future in in_flight:
+                future.cancel()
+
+    return fetched
@@ -0,0 +1,180 @@
+import json
+import os
+import sys
+
+
+"""
+Append-only store for per-subreddit metadata records (used by
+seed_subreddits/seed_metadata.py instead of one small JSON file per
+subreddit).
+
+A store is a directory of JSON Lines segments (segment-00000.jsonl, ...), each
+capped at `segment_size` bytes, plus index.tsv with one
+"subreddit<TAB>segment<TAB>byte offset" line per record. The index is loaded
+into a dict on open, so checking whether a subreddit was already collected is
+a dict lookup and reading one record back is a single seek. Records are only
+ever appended; if a subreddit is written twice, the later record wins.
+
+Each record is {"subreddit": ..., "metadata": ..., "collected_date": ...},
+the same content as the old per-subreddit files.
+
+To convert an old outputs/subreddit_metadata/ directory of per-subreddit
+files into a store:
+
+python metadata_store.py migrate outputs/subreddit_metadata/ outputs/subreddit_metadata_store/
+"""
+
+segment_name = "segment-{:05d}.jsonl"
+index_name = "index.tsv"
+
+
+class MetadataStore:
+
+    def __init__(self, path, segment_size = 256 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok = True)
+
+        ## {subreddit: (segment number, byte offset)}
+        self.index = {}
+        index_path = os.path.join(path, index_name)
+        if os.path.exists(index_path):
+            with open(index_path, encoding = "utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 3:
+                        self.index[fields[0]] = (int(fields[1]), int(fields[2]))
+
+        segments = sorted([int(fname[8:13]) for fname in os.listdir(path) if fname.startswith("segment-")])
+        self.segment = segments[-1] if segments else 0
+        self._recover_tail()
+
+        self.segment_file = open(self._segment_path(self.segment), "ab")
+        self.index_file = open(index_path, "a", encoding = "utf-8")
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, segment_name.format(segment))
+
+    ## Re-index records at the end of the last segment that were written before
+    ## a crash but never made it into the index, and drop a half-written line
+    def _recover_tail(self):
+        segment_path = self._segment_path(self.segment)
+        if not os.path.exists(segment_path):
+            return
+
+        offsets = [offset for segment, offset in self.index.values() if segment == self.segment]
+        start = max(offsets) if offsets else 0
+        recovered = []
+        with open(segment_path, "rb+") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    f.truncate(offset)
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    f.truncate(offset)
+                    break
+                if self.index.get(record["subreddit"]) != (self.segment, offset):
+                    recovered.append((record["subreddit"], offset))
+                offset += len(line)
+
+        if recovered:
+            with open(os.path.join(self.path, index_name), "a", encoding = "utf-8") as f:
+                for subreddit, offset in recovered:
+                    self.index[subreddit] = (self.segment, offset)
+                    f.write("{}\t{}\t{}\n".format(subreddit, self.segment, offset))
+
+    def __contains__(self, subreddit):
+        return subreddit in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return list(self.index.keys())
+
+    ## Append a record for a subreddit
+    def append(self, subreddit, metadata, collected_date):
+        line = (json.dumps({"subreddit": subreddit, "metadata": metadata, "collected_date": collected_date}) + "\n").encode("utf-8")
+
+        offset = self.segment_file.tell()
+        if offset > 0 and offset + len(line) > self.segment_size:
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self._segment_path(self.segment), "ab")
+            offset = 0
+
+        ## Segment first, then index: a crash in between is repaired by
+        ## _recover_tail() on the next open
+        self.segment_file.write(line)
+        self.segment_file.flush()
+        self.index_file.write("{}\t{}\t{}\n".format(subreddit, self.segment, offset))
+        self.index_file.flush()
+        self.index[subreddit] = (self.segment, offset)
+
+    ## Read back the latest record for a subreddit (None if there isn't one)
+    def get(self, subreddit):
+        if subreddit not in self.index:
+            return None
+        segment, offset = self.index[subreddit]
+        self.segment_file.flush()
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    ## Stream the latest record for every subreddit, in segment order
+    def iter_records(self):
+        self.segment_file.flush()
+        for segment in range(self.segment + 1):
+            segment_path = self._segment_path(segment)
+            if not os.path.exists(segment_path):
+                continue
+            with open(segment_path, "rb") as f:
+                offset = 0
+                for line in f:
+                    record = json.loads(line)
+                    if self.index.get(record["subreddit"]) == (segment, offset):
+                        yield record
+                    offset += len(line)
+
+    def close(self):
+        self.segment_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+## Copy an old directory of per-subreddit <name>.json files into a store,
+## skipping subreddits the store already has. Returns the number copied.
+def migrate_from_directory(old_dir, store):
+    migrated = 0
+    for fname in sorted(os.listdir(old_dir)):
+        if not fname.endswith(".json"):
+            continue
+        subreddit = fname[:-len(".json")]
+        if subreddit in store:
+            continue
+        with open(os.path.join(old_dir, fname)) as f:
+            data = json.load(f)
+        store.append(subreddit, data.get("metadata"), data.get("collected_date"))
+        migrated += 1
+        if migrated % 10000 == 0:
+            print("{} files migrated....".format(migrated), flush=True)
+    return migrated
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "migrate":
+        print("Usage: python metadata_store.py migrate OLD_METADATA_DIR STORE_DIR", flush=True)
+        quit()
+
+    with MetadataStore(sys.argv[3]) as store:
+        migrated = migrate_from_directory(sys.argv[2], store)
+        print("{} subreddits migrated; the store now has {}.".format(migrated, len(store)), flush=True)
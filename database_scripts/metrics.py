@@ -0,0 +1,264 @@
+import bisect
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, perf_counter, strftime
+
+
+"""
+Process-wide metrics for the collection scripts: counters, gauges and latency
+histograms, each keyed by a name and a set of labels.
+
+The hooks are always on and cheap (a dict lookup and a lock per call):
+    - api_request_seconds{endpoint, status, source}: every Reddit API request
+      (reddit_api.RateLimitedRequestor and keyword_search); `source` is
+      "cache" for responses answered by response_cache.py
+    - rate_limit_wait_seconds{limiter}: time spent waiting for a permit
+    - db_query_seconds{statement}: every execute_in_db/bulk_insert/stream_query
+      statement (db_utils)
+    - scrape_seconds{kind}, step_seconds{step}, tie_batch_seconds{phase}: the
+      crawl's scrapes, steps and tie extraction batches
+    - subreddits_scraped{outcome}, subreddits_enqueued{queue}, ties_found{relation}
+    - queue_depth{queue, step}: unprocessed subreddits per queue and step
+
+Nothing is written until start() is called: it appends a JSON snapshot of
+everything to `json_path` every `interval` seconds (one line per snapshot,
+with each counter's rate per minute since the previous one), and, with a
+`prometheus_port`, serves the same metrics in the Prometheus text format at
+http://127.0.0.1:PORT/metrics. stop() writes a final snapshot.
+"""
+
+## Upper bounds of the histogram buckets, in seconds
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+_reporter = None
+_server = None
+
+
+class Histogram:
+
+    def __init__(self, buckets = latency_buckets):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    ## Upper bound of the bucket the q-th quantile falls in
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max), 6)
+        return round(self.max, 6)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted([(key, str(value)) for key, value in labels.items()])))
+
+
+def increment(name, amount = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+## Drop the gauges called `name` that have all of the given labels (e.g. the
+## steps of a queue that have emptied since the last reading)
+def clear_gauges(name, **labels):
+    wanted = set(_key(name, labels)[1])
+    with _lock:
+        for key in [key for key in _gauges if key[0] == name and wanted <= set(key[1])]:
+            del _gauges[key]
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+## Time the block into histogram `name`
+@contextmanager
+def timer(name, **labels):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+
+## A low-cardinality label for an API URL: the path with subreddit and user
+## names replaced, e.g. /r/{name}/about/moderators
+def endpoint_of(url):
+    path = re.sub(r"^[a-z]+://[^/]+", "", url).split("?")[0].rstrip("/")
+    path = re.sub(r"\.json$", "", path)
+    return re.sub(r"^/(r|user|u)/[^/]+", r"/\1/{name}", path) or "/"
+
+
+## Record an API response's latency (time to the response headers, so not
+## counting any rate limit wait) under its endpoint, status and whether it
+## came from the response cache
+def observe_response(response):
+    from_cache = getattr(response, "from_cache", False)
+    seconds = 0.0 if from_cache or response.elapsed is None else response.elapsed.total_seconds()
+    observe("api_request_seconds", seconds, endpoint = endpoint_of(response.url or ""), status = response.status_code, source = "cache" if from_cache else "api")
+
+
+## Every metric's current value, as a dict that serializes to JSON
+def snapshot():
+    with _lock:
+        counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(_counters.items())]
+        gauges = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(_gauges.items())]
+        histograms = [{
+            "name": name,
+            "labels": dict(labels),
+            "count": histogram.count,
+            "sum": round(histogram.sum, 6),
+            "mean": round(histogram.sum / histogram.count, 6) if histogram.count else None,
+            "p50": histogram.quantile(0.5),
+            "p90": histogram.quantile(0.9),
+            "p99": histogram.quantile(0.99),
+            "max": round(histogram.max, 6),
+        } for (name, labels), histogram in sorted(_histograms.items())]
+    return {"timestamp": strftime("%Y-%m-%d %H:%M:%S"), "counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels]) + "}"
+
+
+## Every metric in the Prometheus text exposition format
+def prometheus_text():
+    lines = []
+    typed = set()
+
+    def add_type(name, metric_type):
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE {} {}".format(name, metric_type))
+
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            add_type(name + "_total", "counter")
+            lines.append("{}_total{} {}".format(name, _prometheus_labels(labels), value))
+        for (name, labels), value in sorted(_gauges.items()):
+            add_type(name, "gauge")
+            lines.append("{}{} {}".format(name, _prometheus_labels(labels), value))
+        for (name, labels), histogram in sorted(_histograms.items()):
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _prometheus_labels(labels + (("le", bound),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, _prometheus_labels(labels), histogram.sum))
+            lines.append("{}_count{} {}".format(name, _prometheus_labels(labels), histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        content = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+## Appends a snapshot to a JSON Lines file every `interval` seconds
+class _Reporter:
+
+    def __init__(self, json_path, interval):
+        self.json_path = json_path
+        self.interval = interval
+        if os.path.dirname(json_path):
+            os.makedirs(os.path.dirname(json_path), exist_ok = True)
+        self.started = monotonic()
+        self.last_time = self.started
+        self.last_counters = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        now = monotonic()
+        minutes = max(now - self.last_time, 1e-9) / 60.0
+        report = snapshot()
+        report["elapsed_seconds"] = round(now - self.started, 1)
+        for counter in report["counters"]:
+            key = _key(counter["name"], counter["labels"])
+            counter["per_minute"] = round((counter["value"] - self.last_counters.get(key, 0)) / minutes, 2)
+            self.last_counters[key] = counter["value"]
+        self.last_time = now
+        with open(self.json_path, "a") as f:
+            f.write(json.dumps(report) + "\n")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+
+## Start writing snapshots to `json_path` (if given) every `interval` seconds,
+## and serving /metrics on `prometheus_port` (if given)
+def start(json_path = None, interval = 60.0, prometheus_port = None, host = "127.0.0.1"):
+    global _reporter, _server
+    if json_path and _reporter is None:
+        _reporter = _Reporter(json_path, interval)
+    if prometheus_port and _server is None:
+        _server = ThreadingHTTPServer((host, prometheus_port), _PrometheusHandler)
+        _server.daemon_threads = True
+        threading.Thread(target = _server.serve_forever, daemon = True).start()
+        print("Serving metrics on http://{}:{}/metrics".format(host, prometheus_port), flush=True)
+
+
+## Write a final snapshot and stop the reporter and the endpoint
+def stop():
+    global _reporter, _server
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
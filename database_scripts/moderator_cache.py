@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+
+from db_utils import execute_in_db
+
+
+"""
+In-process cache of moderator roles (the t2_moderator_metadata table) for the
+shared moderator step in crawler.py.
+
+Power moderators show up on thousands of subreddits, so looking their roles up
+one SELECT at a time re-reads the same rows over and over. ModeratorRoleCache
+keeps {username: [moderated subreddits]} in a bounded LRU:
+
+- preload(usernames) reads every username that isn't cached yet with one
+  `username = ANY(%s)` query;
+- ensure(reddit, usernames) also scrapes (and stores) the roles of usernames
+  that aren't in the table at all. A username that is already being scraped by
+  another thread is waited on rather than scraped twice;
+- get(username) returns the cached roles.
+
+Moderators whose roles couldn't be pulled (has_metadata = -1) or that are
+marked skip are cached with no roles, same as the old per-moderator query.
+So each moderator is read from the database at most once per run (unless it
+falls out of the LRU) and scraped from the API at most once ever.
+"""
+
+select_roles_sql = """ SELECT username, has_metadata, skip, subreddits_moderated FROM t2_moderator_metadata WHERE username = ANY(%s) """
+add_moderator_roles_to_table_sql = """ INSERT INTO t2_moderator_metadata (username, subreddits_moderated, has_metadata) VALUES (%s, %s, 1) """
+mark_moderator_unsuccessful_sql = """ INSERT INTO t2_moderator_metadata (username, has_metadata) VALUES (%s, -1) """
+
+
+class ModeratorRoleCache:
+
+    ## scrape_roles(reddit, username) returns the list of subreddits moderated
+    ## by the user, or None if they can't be pulled
+    def __init__(self, scrape_roles, max_size = 200000):
+        self.scrape_roles = scrape_roles
+        self.max_size = max_size
+        self.roles = OrderedDict()
+        self.lock = threading.Lock()
+
+        ## {username: threading.Event set when the scrape finishes}
+        self.in_flight = {}
+
+        self.hits = 0
+        self.db_reads = 0
+        self.api_fetches = 0
+
+    def _put(self, username, roles):
+        self.roles[username] = roles
+        self.roles.move_to_end(username)
+        while len(self.roles) > self.max_size:
+            self.roles.popitem(last = False)
+
+    ## Load the roles of every username that isn't cached yet with one query.
+    ## Returns the usernames that aren't in the table at all.
+    def preload(self, usernames):
+        with self.lock:
+            missing = sorted(set([username for username in usernames if username and username not in self.roles]))
+            self.hits += len(set([username for username in usernames if username in self.roles]))
+        if not missing:
+            return []
+
+        rows = execute_in_db(select_roles_sql, return_results = True, args = [missing])
+        found = set()
+        with self.lock:
+            self.db_reads += len(missing)
+            for username, has_metadata, skip, subreddits_moderated in rows:
+                found.add(username)
+                if has_metadata == 1 and skip == 0 and subreddits_moderated:
+                    self._put(username, list(subreddits_moderated))
+                else:
+                    self._put(username, [])
+
+        return [username for username in missing if username not in found]
+
+    ## Make sure the roles of every username are in the table (scraping the
+    ## ones that aren't) and in the cache
+    def ensure(self, reddit, usernames):
+        for username in self.preload(usernames):
+            self._fetch(reddit, username)
+
+    def _fetch(self, reddit, username):
+        with self.lock:
+            if username in self.roles:
+                return
+            event = self.in_flight.get(username)
+            is_owner = event is None
+            if is_owner:
+                event = self.in_flight[username] = threading.Event()
+
+        if not is_owner:
+            event.wait()
+            return
+
+        try:
+            moderated_subreddits = self.scrape_roles(reddit, username)
+            self.api_fetches += 1
+            if moderated_subreddits:
+                execute_in_db(add_moderator_roles_to_table_sql, args = [username, moderated_subreddits])
+            else:
+                print("\tmarking {} unsuccessful".format(username))
+                execute_in_db(mark_moderator_unsuccessful_sql, args = [username])
+            with self.lock:
+                self._put(username, moderated_subreddits or [])
+        finally:
+            with self.lock:
+                del self.in_flight[username]
+            event.set()
+
+    ## The subreddits moderated by `username` (None if they aren't in the table)
+    def get(self, username):
+        with self.lock:
+            if username in self.roles:
+                self.hits += 1
+                self.roles.move_to_end(username)
+                return self.roles[username]
+        self.preload([username])
+        with self.lock:
+            return self.roles.get(username)
+
+    def print_stats(self):
+        print("moderator cache: {} cached, {} hits, {} read from the database, {} scraped".format(len(self.roles), self.hits, self.db_reads, self.api_fetches), flush=True)
@@ -0,0 +1,171 @@
+import argparse
+import csv
+
+import numpy as np
+from scipy import sparse
+
+from db_utils import init_db, close_db, execute_in_db, transaction, bulk_insert
+
+
+"""
+Shared-moderator ties for the whole graph at once, as sparse matrix operations.
+
+load_matrices() reads two matrices over one subreddit index:
+
+- L, source x moderator: the moderator listing (t2_subreddit_metadata.moderators)
+  of every subreddit processed in t1c_moderator_queue, the same listing
+  crawler.moderator_step() reads (deleted and suspended accounts are stored
+  as null there, so they drop out);
+- R, moderator x target: the roles in t2_moderator_metadata of the listed
+  moderators, the ones ModeratorRoleCache hands moderator_step() (moderators
+  whose roles couldn't be pulled or that are marked skip have none).
+
+Then:
+
+- shared_moderator_counts() is the product L R (with the diagonal dropped):
+  entry (s, t) is the number of moderators on s's listing who moderate t;
+- labeled_ties() expands every (source, moderator) entry of L into the
+  moderator's row of R, giving every (source, target, moderator) triple, i.e.
+  the rows of t1c_moderator_ties, with numpy index arithmetic instead of Python
+  loops. It works through the entries in chunks of at most `max_pairs`
+  triples, so moderators of thousands of subreddits don't blow up memory.
+
+The triples are exactly the ones moderator_step() adds one subreddit at a time
+from the same tables (check_moderator_parity.py checks it), so --replace
+rebuilds what the crawl wrote, as long as the listings and roles haven't been
+changed since (e.g. a moderator marked skip afterwards loses their ties).
+
+To rebuild t1c_moderator_ties after a crawl (and optionally write the
+shared-moderator counts as a source,target,shared_moderators CSV):
+
+python moderator_projection.py ../../db_config.txt [--replace] [--counts-out counts.csv]
+"""
+
+select_listings_sql = """ SELECT m.subreddit, m.moderators FROM t1c_moderator_queue q
+    JOIN t2_subreddit_metadata m ON m.subreddit = q.subreddit
+    WHERE q.processed = 1 AND m.has_metadata = 1 """
+select_roles_sql = """ SELECT username, subreddits_moderated FROM t2_moderator_metadata
+    WHERE username = ANY(%s) AND has_metadata = 1 AND skip = 0 AND subreddits_moderated IS NOT NULL """
+
+
+## Returns (L and R as CSR matrices, array of moderator names, array of
+## subreddit names)
+def load_matrices():
+    subreddit_index = {}
+    moderator_index = {}
+    listing_entries = set()
+    for subreddit, listed in execute_in_db(select_listings_sql, return_results = True):
+        source = subreddit_index.setdefault(subreddit, len(subreddit_index))
+        for username in listed or []:
+            if username:
+                listing_entries.add((source, moderator_index.setdefault(username, len(moderator_index))))
+
+    role_entries = set()
+    for username, subreddits_moderated in execute_in_db(select_roles_sql, return_results = True, args = [list(moderator_index)]):
+        for subreddit in subreddits_moderated:
+            role_entries.add((moderator_index[username], subreddit_index.setdefault(subreddit, len(subreddit_index))))
+
+    subreddits = np.empty(len(subreddit_index), dtype = object)
+    for subreddit, index in subreddit_index.items():
+        subreddits[index] = subreddit
+    moderators = np.empty(len(moderator_index), dtype = object)
+    for username, index in moderator_index.items():
+        moderators[index] = username
+
+    listings = _csr(sorted(listing_entries), (len(subreddits), len(moderators)))
+    roles = _csr(sorted(role_entries), (len(moderators), len(subreddits)))
+    return (listings, roles, moderators, subreddits)
+
+
+def _csr(entries, shape):
+    rows = np.array([row for row, _ in entries], dtype = np.int64)
+    cols = np.array([col for _, col in entries], dtype = np.int64)
+    matrix = sparse.csr_matrix((np.ones(len(entries), dtype = np.int32), (rows, cols)), shape = shape)
+    matrix.sort_indices()
+    return matrix
+
+
+## Subreddit x subreddit matrix of shared moderator counts
+def shared_moderator_counts(listings, roles):
+    projection = (listings @ roles).tocsr()
+    projection.setdiag(0)
+    projection.eliminate_zeros()
+    return projection
+
+
+## Yield (source, target, moderator) arrays for every tie, `max_pairs` at a time
+def labeled_ties(listings, roles, moderators, subreddits, max_pairs = 5000000):
+    indptr = roles.indptr
+    cols = roles.indices
+    row_len = np.diff(indptr).astype(np.int64)
+
+    ## Every (source, moderator) entry of the listings pairs with every entry
+    ## of the moderator's roles
+    entries = listings.tocoo()
+    pairs_per_entry = row_len[entries.col]
+    nonempty = np.flatnonzero(pairs_per_entry)
+    entry_sources = entries.row[nonempty].astype(np.int64)
+    entry_moderators = entries.col[nonempty].astype(np.int64)
+    pairs_per_entry = pairs_per_entry[nonempty]
+
+    ## Chunk boundaries, so no chunk has more than max_pairs pairs (unless a
+    ## single entry does)
+    cumulative = np.cumsum(pairs_per_entry)
+    start = 0
+    while start < len(pairs_per_entry):
+        offset = cumulative[start - 1] if start else 0
+        end = max(int(np.searchsorted(cumulative, offset + max_pairs, side = "right")), start + 1)
+
+        sizes = pairs_per_entry[start:end]
+        pair_sources = np.repeat(entry_sources[start:end], sizes)
+        pair_moderators = np.repeat(entry_moderators[start:end], sizes)
+        group_starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+        within = np.arange(int(sizes.sum())) - group_starts
+        pair_targets = cols[indptr[pair_moderators] + within]
+
+        keep = pair_sources != pair_targets
+        yield (subreddits[pair_sources[keep]], subreddits[pair_targets[keep]], moderators[pair_moderators[keep]])
+        start = end
+
+
+## Rebuild t1c_moderator_ties for every processed subreddit. With replace=True
+## the old ties are deleted first (in the same transaction). Returns
+## (ties inserted, shared moderator count matrix, subreddit names).
+def recompute_moderator_ties(replace = False):
+    listings, roles, moderators, subreddits = load_matrices()
+    print("{} sources x {} moderators x {} targets.".format(len(set(listings.tocoo().row)), len(moderators), len(set(roles.indices))), flush=True)
+
+    def tie_rows():
+        for sources, targets, labels in labeled_ties(listings, roles, moderators, subreddits):
+            yield from zip(sources, targets, labels)
+
+    with transaction():
+        if replace:
+            execute_in_db(""" DELETE FROM t1c_moderator_ties """)
+        inserted = bulk_insert("t1c_moderator_ties", ["source", "target", "label"], tie_rows())
+
+    return (inserted, shared_moderator_counts(listings, roles), subreddits)
+
+
+def write_counts(path, counts, subreddits):
+    counts = counts.tocoo()
+    with open(path, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "target", "shared_moderators"])
+        for source, target, count in zip(counts.row, counts.col, counts.data):
+            writer.writerow([subreddits[source], subreddits[target], int(count)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Rebuild t1c_moderator_ties from the moderator listings and roles")
+    parser.add_argument("db_config_path")
+    parser.add_argument("--replace", action = "store_true", help = "delete the existing ties first")
+    parser.add_argument("--counts-out", help = "write shared moderator counts to this CSV file")
+    args = parser.parse_args()
+
+    init_db(args.db_config_path)
+    inserted, counts, subreddits = recompute_moderator_ties(replace = args.replace)
+    print("{} ties inserted; {} subreddit pairs share a moderator.".format(inserted, counts.nnz), flush=True)
+    if args.counts_out:
+        write_counts(args.counts_out, counts, subreddits)
+    close_db()
@@ -0,0 +1,133 @@
+import threading
+from time import monotonic, sleep
+
+import metrics
+
+
+"""
+A token bucket shared by every thread that talks to the Reddit API.
+
+Each request takes one permit with acquire(). Permits refill continuously at
+`requests_per_minute`, and up to `burst` of them can be saved up, so a short
+idle stretch lets the next few requests go out immediately instead of sleeping
+a fixed 60 seconds every 60 requests.
+
+Pass every response to observe(). Reddit reports the remaining budget for the
+current window in the X-Ratelimit-Remaining/Used/Reset headers; the refill
+rate is reset to spread the remaining requests evenly over the rest of the
+window, and nothing is handed out once the window is used up until it resets.
+A 429 response pauses every caller for Retry-After seconds.
+
+print_stats() shows how long callers spent waiting for permits compared to
+the time spent on the requests themselves.
+"""
+
+
+class RateLimiter:
+
+    def __init__(self, requests_per_minute = 60, burst = 10, name = "reddit"):
+        self.name = name
+        self.default_rate = requests_per_minute / 60.0
+        self.rate = self.default_rate
+        self.capacity = burst
+        self.tokens = burst
+        self.last_refill = monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+        ## Counters
+        self.started = monotonic()
+        self.request_count = 0
+        self.wait_seconds = 0.0
+        self.work_seconds = 0.0
+        self.too_many_requests_count = 0
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    ## Block until a request permit is available, then take it
+    def acquire(self):
+        start = monotonic()
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.request_count += 1
+                        self.wait_seconds += now - start
+                        break
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+        metrics.observe("rate_limit_wait_seconds", now - start, limiter = self.name)
+
+    ## Add the time spent on a request (after acquire() returned)
+    def record_work(self, seconds):
+        with self.lock:
+            self.work_seconds += seconds
+
+    ## Update the budget from a response's rate limit headers (and back off on
+    ## a 429)
+    def observe(self, response):
+        headers = response.headers
+        with self.lock:
+            self._refill()
+            try:
+                remaining = float(headers["X-Ratelimit-Remaining"])
+                reset = float(headers["X-Ratelimit-Reset"])
+            except (KeyError, TypeError, ValueError):
+                remaining, reset = None, None
+
+            if remaining is not None:
+                if remaining < 1:
+                    ## Window used up: nothing more until it resets
+                    self.tokens = 0
+                    self.blocked_until = max(self.blocked_until, monotonic() + reset)
+                else:
+                    self.rate = remaining / max(reset, 1.0)
+                    self.tokens = min(self.tokens, remaining)
+
+            if response.status_code == 429:
+                self.too_many_requests_count += 1
+                try:
+                    retry_after = float(headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    retry_after = reset if reset else 60.0
+                self.tokens = 0
+                self.blocked_until = max(self.blocked_until, monotonic() + retry_after)
+
+    ## Send a request with send() (e.g. a lambda around requests.get) under the
+    ## limiter, retrying after a 429 up to `max_retries` times
+    def call(self, send, max_retries = 5):
+        for attempt in range(max_retries + 1):
+            self.acquire()
+            start = monotonic()
+            response = send()
+            self.record_work(monotonic() - start)
+            self.observe(response)
+            if response.status_code != 429 or attempt == max_retries:
+                break
+            print("\tRate limited ({}), retrying.... attempt #{}".format(self.name, attempt + 1), flush=True)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.request_count,
+                "too_many_requests": self.too_many_requests_count,
+                "elapsed_seconds": monotonic() - self.started,
+                "wait_seconds": self.wait_seconds,
+                "work_seconds": self.work_seconds,
+                "current_rate_per_minute": self.rate * 60,
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print("{}: {} requests ({} rate limited) in {:.1f}s; {:.1f}s waiting for permits, {:.1f}s on requests; current rate {:.1f}/min".format(
+            self.name, stats["requests"], stats["too_many_requests"], stats["elapsed_seconds"],
+            stats["wait_seconds"], stats["work_seconds"], stats["current_rate_per_minute"]), flush=True)
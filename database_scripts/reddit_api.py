@@ -0,0 +1,96 @@
+
+import praw
+import prawcore
+import requests
+
+import metrics
+from response_cache import CachedSession
+
+
+"""
+Shared PRAW setup for the collection scripts.
+
+`reddit_config_path` points to a text file in the following format:
+
+user_agent=NAME_OF_USER_AGENT
+client_id=CLIENT_ID
+client_secret=CLIENT_SECRET
+username=USERNAME
+password=PASSWORD
+
+Any other PRAW setting can be added the same way, e.g. `oauth_url` and
+`reddit_url` to point the scripts at a local fake_reddit.py server.
+
+init_reddit() returns a PRAW Reddit object; init_reddit_session() returns a
+bare prawcore session for reading raw JSON (see reddit_json.py). Both send
+every request through the same kind of rate-limited requestor. Pass a
+ResponseCache (response_cache.py) as `cache` to answer repeated requests from
+disk; only the requests that miss the cache then take a rate limit permit.
+Pass a Cassette (cassette.py) as `cassette` to record every exchange for an
+offline replay.
+"""
+
+
+## prawcore requestor that takes a permit from a shared RateLimiter before
+## every HTTP request and reports the rate limit headers back to it, so
+## several PRAW instances (one per worker thread) stay inside one global
+## request budget
+class RateLimitedRequestor(prawcore.Requestor):
+
+    def __init__(self, *args, rate_limiter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    ## With a rate limiter, a 429 is retried after Retry-After (see
+    ## RateLimiter.call()) rather than handed to prawcore, which would raise
+    ## TooManyRequests
+    def request(self, *args, **kwargs):
+        def send():
+            response = super(RateLimitedRequestor, self).request(*args, **kwargs)
+            metrics.observe_response(response)
+            return response
+
+        return self.rate_limiter.call(send) if self.rate_limiter else send()
+
+
+## Read the reddit config file into a dict of PRAW settings
+def read_reddit_config(reddit_config_path):
+    reddit_config = {}
+    with open(reddit_config_path) as f:
+        for line in f.readlines():
+            key, value = line.split("=")
+            reddit_config[key.strip()] = value.strip()
+    return reddit_config
+
+
+## Requestor arguments for a rate limiter, an optional response cache (with
+## a cache, the cached session takes the permits, for the misses only) and an
+## optional cassette to record the exchanges to
+def requestor_kwargs(rate_limiter = None, cache = None, cassette = None):
+    kwargs = {"rate_limiter": rate_limiter}
+    if cache is not None:
+        kwargs = {"rate_limiter": None, "session": CachedSession(cache, rate_limiter = rate_limiter)}
+    if cassette is not None:
+        kwargs.setdefault("session", requests.Session())
+        cassette.attach(kwargs["session"])
+    return kwargs
+
+
+## Authenticate PRAW API object
+def init_reddit(reddit_config_path, rate_limiter = None, cache = None, cassette = None):
+    print("Creating Reddit object...", flush=True)
+    reddit_config = read_reddit_config(reddit_config_path)
+    reddit = praw.Reddit(requestor_class = RateLimitedRequestor, requestor_kwargs = requestor_kwargs(rate_limiter, cache, cassette), **reddit_config)
+    return reddit
+
+
+## Authenticate a bare prawcore session (for reddit_json.py): session.request()
+## returns the raw JSON of an API path instead of PRAW objects
+def init_reddit_session(reddit_config_path, rate_limiter = None, cache = None, cassette = None):
+    reddit_config = read_reddit_config(reddit_config_path)
+    urls = dict([(key, reddit_config[key]) for key in ["oauth_url", "reddit_url"] if key in reddit_config])
+    requestor = RateLimitedRequestor(user_agent = reddit_config["user_agent"], **requestor_kwargs(rate_limiter, cache, cassette), **urls)
+    authenticator = prawcore.TrustedAuthenticator(requestor = requestor, client_id = reddit_config["client_id"], client_secret = reddit_config["client_secret"])
+    authorizer = prawcore.ScriptAuthorizer(authenticator = authenticator, username = reddit_config["username"], password = reddit_config["password"])
+    authorizer.refresh()
+    return prawcore.Session(authorizer = authorizer)
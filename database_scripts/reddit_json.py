@@ -0,0 +1,175 @@
+import json
+import re
+
+import prawcore
+
+
+"""
+Lean Reddit API client for the crawler's metadata rows: reads the raw JSON of
+/r/NAME/about, /about/moderators, /about/rules, /api/info and
+/user/NAME/moderated_subreddits through a prawcore session (see
+reddit_api.init_reddit_session) instead of PRAW's lazy objects.
+
+SubredditMetadata decodes the about JSON straight into a slotted record with
+native Python types that match the t2_subreddit_metadata columns (bool, int,
+float, text), so nothing is turned into a string and parsed back by the
+database. update_args() is bound directly to `update_metadata_sql`, which
+also writes the derived columns: complete_metadata_text (the text the
+snowball step searches, built here with complete_metadata_text()) and
+created_utc_ts, so no pass over the table is needed to fill them in
+afterwards (backfill_metadata_text.py does it for rows scraped before).
+
+The moderators come from the moderator listing. The old scraper loaded every
+moderator's profile to drop deleted accounts, which cost one extra request per
+moderator; pass an AccountStatusCache (account_status.py) to fetch_record()
+to get the same result from a cached, batched lookup instead.
+"""
+
+## (column, key in the about JSON, type), in the order of the UPDATE
+metadata_columns = [
+    ("display_name", "display_name", str),
+    ("free_form_reports", "free_form_reports", bool),
+    ("subreddit_type", "subreddit_type", str),
+    ("community_icon", "community_icon", str),
+    ("banner_background_image", "banner_background_image", str),
+    ("header_title", "header_title", str),
+    ("over18", "over18", bool),
+    ("show_media", "show_media", bool),
+    ("description", "description", str),
+    ("title", "title", str),
+    ("collapse_deleted_comments", "collapse_deleted_comments", bool),
+    ("subreddit_id", "id", str),
+    ("emojis_enabled", "emojis_enabled", bool),
+    ("can_assign_user_flair", "can_assign_user_flair", bool),
+    ("allow_videos", "allow_videos", bool),
+    ("spoilers_enabled", "spoilers_enabled", bool),
+    ("active_user_count", "active_user_count", int),
+    ("original_content_tag_enabled", "original_content_tag_enabled", bool),
+    ("display_name_prefixed", "display_name_prefixed", str),
+    ("can_assign_link_flair", "can_assign_link_flair", bool),
+    ("submit_text", "submit_text", str),
+    ("allow_videogifs", "allow_videogifs", bool),
+    ("accounts_active", "accounts_active", int),
+    ("public_traffic", "public_traffic", bool),
+    ("subscribers", "subscribers", int),
+    ("all_original_content", "all_original_content", bool),
+    ("lang", "lang", str),
+    ("has_menu_widget", "has_menu_widget", bool),
+    ("name", "name", str),
+    ("user_flair_enabled_in_sr", "user_flair_enabled_in_sr", bool),
+    ("created", "created", float),
+    ("url", "url", str),
+    ("quarantine", "quarantine", bool),
+    ("hide_ads", "hide_ads", bool),
+    ("created_utc", "created_utc", float),
+    ("allow_discovery", "allow_discovery", bool),
+    ("accounts_active_is_fuzzed", "accounts_active_is_fuzzed", bool),
+    ("advertiser_category", "advertiser_category", str),
+    ("public_description", "public_description", str),
+    ("link_flair_enabled", "link_flair_enabled", bool),
+    ("allow_images", "allow_images", bool),
+    ("videostream_links_count", "videostream_links_count", int),
+    ("comment_score_hide_mins", "comment_score_hide_mins", int),
+    ("show_media_preview", "show_media_preview", bool),
+    ("submission_type", "submission_type", str),
+]
+
+## The text columns that go into complete_metadata_text, in order (followed
+## by the rules JSON)
+complete_text_columns = ["display_name", "header_title", "description", "title", "submit_text", "name", "public_description"]
+
+update_metadata_sql = """ UPDATE t2_subreddit_metadata SET {}, moderators = %s, rules = %s, complete_metadata_text = %s,
+    created_utc_ts = to_timestamp(%s), has_metadata = 1 WHERE subreddit = %s """.format(
+    ", ".join(["{} = %s".format(column) for column, _, _ in metadata_columns]))
+
+_line_breaks = re.compile("[\n\r]+")
+
+
+## The combined text field of a subreddit: each field with double quotes
+## removed and line breaks turned into spaces, joined with spaces (missing
+## fields are skipped). The same text the old
+## CONCAT_WS(' ', REGEXP_REPLACE(REPLACE(...))) UPDATE built in the database.
+def complete_metadata_text(fields):
+    return " ".join([_line_breaks.sub(" ", field.replace('"', '')) for field in fields if field is not None])
+
+
+def _convert(value, column_type):
+    if value is None or isinstance(value, column_type):
+        return value
+    if column_type is bool:
+        return bool(value)
+    if column_type is str:
+        return str(value)
+    try:
+        return column_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SubredditMetadata:
+
+    __slots__ = ["subreddit"] + [column for column, _, _ in metadata_columns] + ["moderators", "rules", "complete_metadata_text"]
+
+    ## `moderators` is a list of usernames and `rules` the list of rule objects
+    ## from /about/rules; both are stored as JSON
+    def __init__(self, subreddit, about, moderators, rules):
+        self.subreddit = subreddit
+        for column, key, column_type in metadata_columns:
+            setattr(self, column, _convert(about.get(key), column_type))
+        self.moderators = json.dumps(moderators)
+        self.rules = json.dumps(rules)
+        ## The rules as stored (the column is json, so ::TEXT gives back this
+        ## exact string)
+        self.complete_metadata_text = complete_metadata_text([getattr(self, column) for column in complete_text_columns] + [self.rules])
+
+    ## Arguments for update_metadata_sql
+    def update_args(self):
+        return [getattr(self, column) for column, _, _ in metadata_columns] + [self.moderators, self.rules, self.complete_metadata_text, self.created_utc, self.subreddit]
+
+
+def fetch_about(session, subreddit_name):
+    return session.request(method = "GET", path = "/r/{}/about".format(subreddit_name), params = {"raw_json": 1})["data"]
+
+
+## [(username, account fullname)] of a subreddit's moderators
+def fetch_moderators(session, subreddit_name):
+    listing = session.request(method = "GET", path = "/r/{}/about/moderators".format(subreddit_name), params = {"raw_json": 1})
+    return [(moderator["name"], moderator.get("id")) for moderator in listing["data"]["children"]]
+
+
+def fetch_rules(session, subreddit_name):
+    return session.request(method = "GET", path = "/r/{}/about/rules".format(subreddit_name), params = {"raw_json": 1}).get("rules")
+
+
+## {lowercased name: about data} for up to 100 subreddit names (missing
+## subreddits aren't in the result)
+def fetch_info(session, subreddit_names):
+    listing = session.request(method = "GET", path = "/api/info", params = {"sr_name": ",".join(subreddit_names), "raw_json": 1})
+    return dict([(child["data"]["display_name"].lower(), child["data"]) for child in listing["data"]["children"]])
+
+
+## The (lowercased) names of the subreddits a user moderates
+def fetch_moderated(session, username):
+    listing = session.request(method = "GET", path = "/user/{}/moderated_subreddits".format(username), params = {"raw_json": 1})
+    return [subreddit["sr"].lower() for subreddit in (listing.get("data") or [])]
+
+
+## The full SubredditMetadata record for a subreddit whose about data has been
+## read (None if the moderators or rules can't be pulled, e.g. because the
+## subreddit was banned or made private since its about data was read). With
+## an AccountStatusCache (account_status.py), moderators whose accounts are
+## deleted or suspended are stored as null, like the old scraper did.
+def fetch_record(session, subreddit_name, about, account_status = None):
+    try:
+        moderators = fetch_moderators(session, subreddit_name)
+        rules = fetch_rules(session, subreddit_name)
+    except (prawcore.exceptions.NotFound, prawcore.exceptions.Forbidden, prawcore.exceptions.Redirect, prawcore.exceptions.BadRequest, prawcore.exceptions.ServerError, KeyError):
+        return
+
+    if account_status is not None:
+        exists = account_status.check(session, moderators)
+        moderator_names = [username if exists.get(username, True) else None for username, _ in moderators]
+    else:
+        moderator_names = [username for username, _ in moderators]
+
+    return SubredditMetadata(subreddit_name, about, moderator_names, rules)
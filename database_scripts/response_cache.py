@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import timedelta
+from time import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.hooks import dispatch_hook
+from requests.structures import CaseInsensitiveDict
+
+from cassette import request_key
+
+
+"""
+On-disk cache of Reddit API responses, shared by every collection script so
+reruns (and scripts that scrape the same subreddits) read unchanged responses
+from local disk instead of the API.
+
+Responses are stored in sqlite, keyed by a hash of the normalized request:
+method, path (lowercased, without the host, a trailing slash or `.json`) and
+the sorted query parameters. So the same subreddit's about page is one entry
+whether it was fetched through PRAW (oauth.reddit.com) or plain requests
+(www.reddit.com). Only GET responses for the endpoints in `endpoint_ttls` are
+cached, each for its own time to live. 403/404 responses are only kept for
+`error_ttl` (or the endpoint's time to live, if shorter): long enough that one
+run doesn't ask about a private or banned subreddit twice, short enough that a
+subreddit that went private for a while is looked at again by the next run.
+Once the file passes `max_bytes` the least recently read entries are evicted.
+
+The scripts only open the cache when their `use_response_cache` setting is on.
+
+CachedSession is a requests.Session that answers from a ResponseCache. It
+plugs into both HTTP paths: keyword_search.make_session(cache = ...) for the
+search requests, and reddit_api.init_reddit / init_reddit_session(cache = ...)
+for PRAW and prawcore. Give it the RateLimiter instead of the requestor, so
+only the requests that actually go out take a permit.
+"""
+
+hour = 60 * 60
+day = 24 * hour
+
+## (path regex, seconds to keep the response), first match wins
+endpoint_ttls = [
+    (re.compile(r"^/r/[^/]+/about/moderators$"), 1 * day),
+    (re.compile(r"^/r/[^/]+/about/rules$"), 7 * day),
+    (re.compile(r"^/r/[^/]+/about$"), 7 * day),
+    (re.compile(r"^/api/info$"), 7 * day),
+    (re.compile(r"^/subreddits/search$"), 1 * day),
+    (re.compile(r"^/user/[^/]+/moderated_subreddits$"), 1 * day),
+    (re.compile(r"^/user/[^/]+/about$"), 1 * day),
+    (re.compile(r"^/api/user_data_by_account_ids$"), 1 * day),
+]
+
+cached_statuses = [200, 403, 404]
+
+## Seconds to keep the error responses in `cached_statuses`
+error_ttl = 1 * hour
+
+## Headers kept with a cached response (the rate limit headers describe the
+## window the response was fetched in, so they're dropped)
+kept_headers = ["Content-Type"]
+
+## One file for all of the scripts (in /outputs at the top of the repo)
+default_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "outputs", "response_cache.sqlite")
+
+
+## The cache path of a URL: lowercased, without a trailing slash or `.json`
+def normalize_path(url):
+    path = urlsplit(url).path.lower().rstrip("/")
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return path
+
+
+## The cache key of a request (the params can also be in the URL), and the
+## normalized request it's the hash of (see cassette.request_key)
+def cache_key(method, url, params = None):
+    normalized = request_key(method, url, params)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest(), normalized
+
+
+class ResponseCache:
+
+    def __init__(self, path = default_cache_path, ttls = endpoint_ttls, max_bytes = 2 * 1024 ** 3):
+        self.path = path
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        ## Several scripts (and seed_metadata.py's shard processes) can share
+        ## the file, so wait on each other's writes instead of failing
+        self.conn = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+        with self.conn:
+            self.conn.execute(""" PRAGMA journal_mode = WAL """)
+            self.conn.execute(""" CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, request TEXT, status INTEGER, headers TEXT, body BLOB, size INTEGER, stored_at REAL, accessed_at REAL) """)
+            self.conn.execute(""" CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at) """)
+        self.total_bytes = self.conn.execute(""" SELECT COALESCE(SUM(size), 0) FROM responses """).fetchone()[0]
+
+        ## Counters
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stores = 0
+        self.evictions = 0
+
+    ## Seconds to keep responses from a URL (None if it isn't cached)
+    def ttl_for(self, url):
+        path = normalize_path(url)
+        for pattern, ttl in self.ttls:
+            if pattern.match(path):
+                return ttl
+
+    ## (status, headers, body) of a fresh cached response, or None
+    def get(self, method, url, params = None):
+        ttl = self.ttl_for(url)
+        if method.upper() != "GET" or ttl is None:
+            return
+
+        key, _ = cache_key(method, url, params)
+        now = time()
+        with self.lock:
+            row = self.conn.execute(""" SELECT status, headers, body, stored_at FROM responses WHERE key = ? """, (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return
+            if now - row[3] > (ttl if row[0] == 200 else min(ttl, error_ttl)):
+                self.expired += 1
+                self.misses += 1
+                return
+            with self.conn:
+                self.conn.execute(""" UPDATE responses SET accessed_at = ? WHERE key = ? """, (now, key))
+            self.hits += 1
+        return (row[0], json.loads(row[1]), row[2])
+
+    def put(self, method, url, params, status, headers, body):
+        if method.upper() != "GET" or self.ttl_for(url) is None or status not in cached_statuses:
+            return
+
+        key, normalized = cache_key(method, url, params)
+        headers = dict([(name, headers[name]) for name in kept_headers if name in headers])
+        now = time()
+        with self.lock:
+            with self.conn:
+                old = self.conn.execute(""" SELECT size FROM responses WHERE key = ? """, (key,)).fetchone()
+                self.conn.execute(""" INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?) """,
+                    (key, normalized, status, json.dumps(headers), body, len(body), now, now))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            self.stores += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    ## Drop the least recently read entries until the cache is back under 90%
+    ## of max_bytes (called with the lock held)
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        with self.conn:
+            while self.total_bytes > target:
+                rows = self.conn.execute(""" SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1000 """).fetchall()
+                if not rows:
+                    self.total_bytes = 0
+                    break
+                evicted = []
+                for key, size in rows:
+                    if self.total_bytes <= target:
+                        break
+                    evicted.append((key,))
+                    self.total_bytes -= size
+                self.conn.executemany(""" DELETE FROM responses WHERE key = ? """, evicted)
+                self.evictions += len(evicted)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute(""" DELETE FROM responses """)
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "size_bytes": self.total_bytes,
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"]
+        print("response cache: {} hits / {} lookups ({:.1f}%), {} expired, {} stored, {} evicted; {:.1f} MB on disk".format(
+            stats["hits"], lookups, 100.0 * stats["hits"] / max(lookups, 1), stats["expired"], stats["stores"],
+            stats["evictions"], stats["size_bytes"] / 1024.0 ** 2), flush=True)
+
+    def close(self):
+        self.conn.close()
+
+
+## requests.Session that serves cacheable GETs from a ResponseCache. Requests
+## that miss take a permit from `rate_limiter` (retrying on a 429) before
+## they go out; cached ones don't.
+class CachedSession(requests.Session):
+
+    def __init__(self, cache, rate_limiter = None):
+        super().__init__()
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+
+    def request(self, method, url, params = None, **kwargs):
+        cached = self.cache.get(method, url, params)
+        if cached is not None:
+            return self.cached_response(method, url, params, *cached)
+
+        send = lambda: super(CachedSession, self).request(method, url, params = params, **kwargs)
+        response = self.rate_limiter.call(send) if self.rate_limiter else send()
+        self.cache.put(method, url, params, response.status_code, response.headers, response.content)
+        return response
+
+    ## A Response for a cache hit, passed through the session's response hooks
+    ## like a real one (so e.g. a Cassette records it too)
+    def cached_response(self, method, url, params, status, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = "utf-8"
+        response.request = requests.Request(method, url, params = params).prepare()
+        response.url = response.request.url
+        response.elapsed = timedelta(0)
+        response.from_cache = True
+        return dispatch_hook("response", self.hooks, response)
@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+
+
+"""
+Crash-safe progress for the keyword search.
+
+Every page of search results is saved together with the `after` cursor that
+follows it, in one sqlite transaction, so a crash or a bad response partway
+through loses at most the page that was in flight. On restart,
+keyword_search.search_keyword() continues each keyword from its saved cursor
+and skips the keywords that were already finished.
+
+The rows table's (keyword, subreddit) primary key also dedups the rows
+handed on to the caller: save_page() only passes on the rows it hadn't
+saved before.
+
+Delete the checkpoint file (or call clear()) once the collected rows have been
+written out, so the next run starts from scratch.
+"""
+
+
+class SearchCheckpoint:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        with self.conn:
+            self.conn.execute(""" CREATE TABLE IF NOT EXISTS cursors (keyword TEXT PRIMARY KEY, after TEXT, done INTEGER DEFAULT 0, row_count INTEGER DEFAULT 0) """)
+            self.conn.execute(""" CREATE TABLE IF NOT EXISTS rows (keyword TEXT, subreddit TEXT, subreddit_id TEXT, subreddit_title TEXT, description TEXT, link TEXT, searched_text TEXT, PRIMARY KEY (keyword, subreddit)) """)
+
+    ## (last saved after cursor, whether the keyword is finished, rows so far)
+    def resume_state(self, keyword):
+        with self.lock:
+            result = self.conn.execute(""" SELECT after, done, row_count FROM cursors WHERE keyword = ? """, (keyword,)).fetchone()
+        if result is None:
+            return (None, False, 0)
+        return (result[0], bool(result[1]), result[2])
+
+    ## Save a page of rows and the cursor to continue from. The rows the
+    ## checkpoint didn't have yet (by (keyword, subreddit)) are passed to
+    ## on_new_rows(rows) inside the transaction, so if it raises, neither the
+    ## rows nor the cursor are saved. Returns the new rows.
+    def save_page(self, keyword, rows, after, on_new_rows = None):
+        with self.lock, self.conn:
+            new_rows = [row for row in rows if self.conn.execute(""" INSERT OR IGNORE INTO rows VALUES (?, ?, ?, ?, ?, ?, ?) """, row).rowcount]
+            if on_new_rows and new_rows:
+                on_new_rows(new_rows)
+            self.conn.execute(""" INSERT INTO cursors (keyword, after, row_count) VALUES (?, ?, ?)
+                ON CONFLICT (keyword) DO UPDATE SET after = excluded.after, row_count = row_count + excluded.row_count """, (keyword, after, len(new_rows)))
+        return new_rows
+
+    def mark_done(self, keyword):
+        with self.lock, self.conn:
+            self.conn.execute(""" INSERT INTO cursors (keyword, done) VALUES (?, 1)
+                ON CONFLICT (keyword) DO UPDATE SET done = 1 """, (keyword,))
+
+    ## The keywords that haven't been searched to the end yet
+    def unfinished(self, keywords):
+        with self.lock:
+            done = set([row[0] for row in self.conn.execute(""" SELECT keyword FROM cursors WHERE done = 1 """)])
+        return [keyword for keyword in keywords if keyword not in done]
+
+    ## Every saved row, in the same tuple layout extract_subreddits_from_json returns
+    def iter_rows(self):
+        return self.conn.execute(""" SELECT keyword, subreddit, subreddit_id, subreddit_title, description, link, searched_text FROM rows ORDER BY keyword, subreddit """)
+
+    def row_count(self):
+        with self.lock:
+            return self.conn.execute(""" SELECT COUNT(*) FROM rows """).fetchone()[0]
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute(""" DELETE FROM cursors """)
+            self.conn.execute(""" DELETE FROM rows """)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,97 @@
+import gzip
+import json
+
+
+"""
+Streaming seed-search output (the seeds_subreddits_collected_<date> files).
+
+Format version 1 is JSON Lines, gzip-compressed when the file name ends in
+.gz. The first line is a header:
+
+{"format": "seed_subreddits", "version": 1, "keywords": [...], "timestamp": "..."}
+
+and every following line is one search result:
+
+{"keyword": ..., "subreddit": ..., "subreddit_id": ..., "subreddit_title": ...,
+ "description": ..., "link": ..., "searched_text": ...}
+
+SeedWriter writes rows as they are passed in and keeps nothing per row; the
+callers dedup them with the search checkpoint (search_checkpoint.py) before
+they get here. Each write_rows() batch is flushed, so the rows written so far
+can be read back from the file of a run that stopped partway.
+read_seed_file() streams a file back as (header, row iterator), with each row
+as a tuple in the field order above. It also reads the older single-JSON
+document format (treated as version 0) so existing outputs still load.
+"""
+
+format_name = "seed_subreddits"
+format_version = 1
+row_fields = ["keyword", "subreddit", "subreddit_id", "subreddit_title", "description", "link", "searched_text"]
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding = "utf-8")
+    return open(path, mode, encoding = "utf-8")
+
+
+class SeedWriter:
+
+    def __init__(self, path, keywords, timestamp):
+        self.path = path
+        self.f = _open(path, "w")
+        self.row_count = 0
+        header = {"format": format_name, "version": format_version, "keywords": keywords, "timestamp": timestamp}
+        self.f.write(json.dumps(header) + "\n")
+
+    ## Write a row (a tuple in `row_fields` order)
+    def write_row(self, row):
+        self.f.write(json.dumps(dict(zip(row_fields, row))) + "\n")
+        self.row_count += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+## Read a seed output file, returning (header dict, iterator of row tuples).
+## The file is read lazily; exhaust the iterator to close it.
+def read_seed_file(path):
+    f = _open(path, "r")
+    first_line = f.readline()
+    header = json.loads(first_line)
+
+    ## Version 0: the whole output in one JSON document
+    if header.get("format") != format_name:
+        f.close()
+        rows = header.pop("results")
+        header["version"] = 0
+        return (header, (tuple(row) for row in rows))
+
+    if header["version"] > format_version:
+        f.close()
+        raise ValueError("{} is seed output version {}; this reader only supports up to version {}".format(path, header["version"], format_version))
+
+    ## A file from a run that stopped partway ends without the gzip trailer
+    ## (and maybe partway through a line); stop at the last whole row
+    def iter_rows():
+        with f:
+            try:
+                for line in f:
+                    if line.endswith("\n") and line.strip():
+                        row = json.loads(line)
+                        yield tuple(row.get(field) for field in row_fields)
+            except EOFError:
+                print("{} ends early (from an interrupted run?); read the rows up to there".format(path), flush=True)
+
+    return (header, iter_rows())
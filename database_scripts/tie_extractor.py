@@ -0,0 +1,322 @@
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from db_utils import execute_in_db, stream_query, transaction, bulk_insert, enqueue_subreddits
+
+
+"""
+Batch, single-scan tie extraction for the snowball step of
+2_hyperlink_tracing.py.
+
+Every kind of tie (hyperlinks, references, ...) is a Relation: a regex for
+what has to come right before an `r/NAME` mention for it to count, plus the
+ties and queue tables it goes to. The two relations the script uses are
+equivalent to the original patterns:
+
+    hyperlink:  (reddit.com)/r/([A-Za-z0-9_-]+)           -> prefix  reddit.com/
+    reference:  (((^|\s)(/)?)|(reddit.com/))r/([A-Za-z0-9_-]+)
+                                                          -> prefix  (^|\s)/?|reddit.com/
+
+Each document is scanned once for `r/NAME` tokens; for each token the few
+characters before it are checked against every relation's prefix, and the
+name is routed to each relation whose prefix matches.
+
+extract_ties() streams (subreddit, complete_metadata_text, step in each
+relation's queue) for every subreddit that is unprocessed in at least one
+relation queue through a server-side cursor, `batch_size` rows at a time. For
+each batch it:
+
+1. extracts the ties (in a pool of worker processes when a batch has more than
+   `parallel_threshold` characters of text);
+2. for each relation the subreddit is queued in, adds every newly found
+   subreddit to the metadata table and that relation's queue, at one more than
+   the lowest step of the subreddits that name it (lowering the step of one an
+   earlier batch of the level added, if this batch reaches it from lower down);
+3. bulk-inserts the edges and marks the batch processed in each queue,
+
+all in one transaction, so a step costs a handful of round trips per batch
+rather than several per subreddit, and each subreddit's text is read and
+scanned once no matter how many relations it's queued in.
+
+extract_ties_in_db() does the same for a whole level without the text ever
+leaving the database: the prefixes are turned into PostgreSQL regexes
+(sql_tie_pattern()) and the level is extracted, enqueued, written and marked
+processed in one transaction. check_snowball_parity.py checks that both give
+the same ties, queues and metadata stubs.
+"""
+
+Relation = namedtuple("Relation", ["name", "prefix", "edges_table", "queue_table"])
+
+token_pattern = re.compile(r"r/([A-Za-z0-9_-]+)")
+
+## How many characters before a token the relation prefixes can look at
+prefix_window = 16
+
+_compiled_prefixes = {}
+
+
+def _compiled_prefix(prefix):
+    if prefix not in _compiled_prefixes:
+        _compiled_prefixes[prefix] = re.compile("(?:{})\\Z".format(prefix))
+    return _compiled_prefixes[prefix]
+
+
+## One set of other subreddits named in the text per prefix, in order
+def extract_targets(subreddit, text, prefixes):
+    compiled = [_compiled_prefix(prefix) for prefix in prefixes]
+    targets = [set() for _ in prefixes]
+    text = text or ""
+    ## Like re.findall, a relation's matches (prefix included) don't overlap,
+    ## so its prefix can't reach back into the relation's previous match
+    last_end = [0] * len(prefixes)
+    for match in token_pattern.finditer(text):
+        start = match.start()
+        for index, prefix in enumerate(compiled):
+            if prefix.search(text, max(last_end[index], start - prefix_window), start):
+                targets[index].add(match.group(1).lower())
+                last_end[index] = match.end()
+
+    for relation_targets in targets:
+        relation_targets.discard(subreddit)
+    return targets
+
+
+## [(subreddit, steps, targets per prefix)] for a list of
+## (subreddit, text, steps) rows (top-level so it can run in a worker process)
+def _extract_rows(rows, prefixes):
+    return [(subreddit, steps, extract_targets(subreddit, text, prefixes)) for subreddit, text, steps in rows]
+
+
+class TieExtractor:
+
+    def __init__(self, relations, num_processes = None, parallel_threshold = 4 * 1024 * 1024):
+        self.relations = relations
+        self.prefixes = [relation.prefix for relation in relations]
+        self.num_processes = num_processes or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self.executor = None
+
+    ## [(subreddit, steps, targets per relation)] for a list of
+    ## (subreddit, text, steps) rows
+    def extract(self, rows):
+        text_volume = sum([len(text) for _, text, _ in rows if text])
+        if self.num_processes < 2 or text_volume < self.parallel_threshold:
+            return _extract_rows(rows, self.prefixes)
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers = self.num_processes)
+        chunk_size = -(-len(rows) // self.num_processes)
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        results = []
+        for chunk_results in self.executor.map(_extract_rows, chunks, [self.prefixes] * len(chunks)):
+            results.extend(chunk_results)
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+## Write one batch of extracted ties: for each relation, new subreddits to the
+## metadata table and queue, edges to the ties table, and the batch's
+## subreddits marked processed. Returns the number of edges per relation.
+##
+## `queued` holds, per relation, {subreddit: step} of the subreddits earlier
+## batches of the same level added to the queue (and is updated). A target
+## queued by an earlier batch and reached from a lower step in this one has its
+## step lowered, so every subreddit a level adds ends up at one more than the
+## lowest step it's reached from, as extract_ties_in_db() does for the whole
+## level at once. Subreddits that were already queued before the level keep
+## their step in both engines.
+def write_tie_batch(extracted, relations, queued = None):
+    if queued is None:
+        queued = [{} for _ in relations]
+
+    edge_counts = []
+    with transaction():
+        for index, relation in enumerate(relations):
+            set_processed_q = """ UPDATE {} SET processed = 1 WHERE subreddit = ANY(%s) """.format(relation.queue_table)
+            select_queued_q = """ SELECT subreddit FROM {} WHERE subreddit = ANY(%s) """.format(relation.queue_table)
+            lower_step_q = """ UPDATE {} SET step = LEAST(step, %s) WHERE subreddit = %s AND processed = 0 """.format(relation.queue_table)
+
+            ## The lowest step each target is reached from, and every edge
+            ## (deduplicated), from the subreddits queued in this relation
+            frontier = {}
+            edges = set()
+            processed = []
+            for subreddit, steps, targets in extracted:
+                step = steps[index]
+                if step is None:
+                    continue
+                processed.append(subreddit)
+                for target in targets[index]:
+                    edges.add((subreddit, target, None))
+                    if target not in frontier or step + 1 < frontier[target]:
+                        frontier[target] = step + 1
+
+            ## Targets this level already queued only move to a lower step;
+            ## of the rest, the ones that aren't in the queue yet are added
+            lowered = [(step, target) for target, step in frontier.items() if target in queued[index] and step < queued[index][target]]
+            new_targets = [target for target in frontier if target not in queued[index]]
+            in_queue = set([subreddit for subreddit, in execute_in_db(select_queued_q, return_results = True, args = [new_targets])]) if new_targets else set()
+
+            targets_by_step = {}
+            for target in new_targets:
+                if target not in in_queue:
+                    targets_by_step.setdefault(frontier[target], []).append(target)
+
+            if lowered:
+                execute_in_db(lower_step_q, args = sorted(lowered, key = lambda pair: pair[1]), batch_insert = True)
+                queued[index].update([(target, step) for step, target in lowered])
+            for step in sorted(targets_by_step):
+                enqueue_subreddits(targets_by_step[step], relation.queue_table, step)
+                queued[index].update([(target, step) for target in targets_by_step[step]])
+            if edges:
+                metrics.increment("ties_found", bulk_insert(relation.edges_table, ["source", "target", "label"], sorted(edges)), relation = relation.name)
+            if processed:
+                execute_in_db(set_processed_q, args = [processed])
+            edge_counts.append(len(edges))
+
+    return edge_counts
+
+
+## (subreddit, complete_metadata_text, step in each queue) for every subreddit
+## unprocessed in at least one of `queue_tables`. Each queue's unprocessed
+## entries are read once, from its partial index (see 0_create_indexes.sql),
+## and the queues are lined up with FULL JOINs, so a subreddit queued in
+## several of them comes out once with all of its steps (NULL where it isn't
+## unprocessed).
+def unprocessed_text_sql(queue_tables):
+    subreddits = []
+    joined = ""
+    for index, queue_table in enumerate(queue_tables):
+        unprocessed = "(SELECT subreddit, step FROM {} WHERE processed = 0) q{}".format(queue_table, index)
+        if index == 0:
+            joined = unprocessed
+        else:
+            joined += "\n            FULL JOIN {} ON q{}.subreddit = COALESCE({})".format(unprocessed, index, ", ".join(subreddits))
+        subreddits.append("q{}.subreddit".format(index))
+    steps = ", ".join(["q{}.step AS step{}".format(index, index) for index in range(len(queue_tables))])
+    return """ SELECT m.subreddit, m.complete_metadata_text, {} FROM (
+        SELECT COALESCE({}) AS subreddit, {}
+            FROM {}) u
+        JOIN t2_subreddit_metadata m ON m.subreddit = u.subreddit
+        ORDER BY m.subreddit """.format(", ".join(["u.step{}".format(index) for index in range(len(queue_tables))]), ", ".join(subreddits), steps, joined)
+
+
+## Extract and write the ties of every subreddit that is unprocessed in at
+## least one relation's queue. Returns (subreddits processed, edges found per
+## relation).
+def extract_ties(extractor, batch_size = 2000):
+    relations = extractor.relations
+    processed = 0
+    edge_counts = [0] * len(relations)
+    ## The subreddits this level has added to each relation's queue so far
+    queued = [{} for _ in relations]
+    for rows in stream_query(unprocessed_text_sql([relation.queue_table for relation in relations]), batch_size = batch_size):
+        rows = [(row[0], row[1], row[2:]) for row in rows]
+        with metrics.timer("tie_batch_seconds", phase = "extract"):
+            extracted = extractor.extract(rows)
+        with metrics.timer("tie_batch_seconds", phase = "write"):
+            batch_counts = write_tie_batch(extracted, relations, queued = queued)
+        edge_counts = [total + count for total, count in zip(edge_counts, batch_counts)]
+        processed += len(rows)
+        print("\t{} subreddits processed, {} edges found".format(processed, ", ".join(["{} {}".format(count, relation.name) for count, relation in zip(edge_counts, relations)])), flush = True)
+
+    return (processed, edge_counts)
+
+
+############################
+## In-database extraction ##
+############################
+
+## Python's \s (every character str.isspace() is true for), spelled out for
+## PostgreSQL, whose [[:space:]] depends on the database locale
+_python_whitespace = "[{}]".format("".join([chr(code) for code in range(0x110000) if chr(code).isspace()]))
+
+
+## A relation's prefix, followed by the `r/NAME` token, as a PostgreSQL regex
+## that matches exactly what extract_targets() does: \s is Python's whitespace
+## and `.` doesn't match a newline, as in Python (the prefixes only use syntax
+## the two regex flavours share otherwise)
+def sql_tie_pattern(prefix):
+    translated = []
+    escaped = False
+    in_brackets = False
+    for char in prefix:
+        if escaped:
+            translated.append(_python_whitespace if char == "s" and not in_brackets else "\\" + char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "." and not in_brackets:
+            translated.append("[^\\n]")
+        else:
+            if char == "[":
+                in_brackets = True
+            elif char == "]":
+                in_brackets = False
+            translated.append(char)
+    return "(?:{}){}".format("".join(translated), token_pattern.pattern)
+
+
+## Run one level of the snowball (every subreddit unprocessed in at least one
+## relation's queue) inside the database, as a handful of set-based statements
+## in one transaction instead of streaming the text out and the edges back:
+##
+## 1. the level (unprocessed_text_sql()) goes into a temp table,
+## 2. each relation's ties are extracted with regexp_matches() over the whole
+##    level (sql_tie_pattern(), so the ties are the ones extract_ties() finds),
+## 3. new subreddits are added to the metadata table, and to each relation's
+##    queue at one more than the lowest step of the subreddits that name them
+##    (subreddits already queued keep their step),
+## 4. the edges are inserted and the level is marked processed in each queue.
+##
+## Returns (subreddits processed, edges found per relation), like
+## extract_ties().
+def extract_ties_in_db(relations):
+    create_level_q = """ CREATE TEMP TABLE snowball_level ON COMMIT DROP AS {} """.format(unprocessed_text_sql([relation.queue_table for relation in relations]))
+    create_ties_q = """ CREATE TEMP TABLE snowball_ties ON COMMIT DROP AS {} """.format(" UNION ALL ".join(["""
+        SELECT DISTINCT {} AS relation, l.subreddit AS source, lower(t.match[array_length(t.match, 1)]) AS target, l.step{} AS step
+        FROM snowball_level l CROSS JOIN LATERAL regexp_matches(l.complete_metadata_text, %s, 'g') AS t(match)
+        WHERE l.step{} IS NOT NULL AND lower(t.match[array_length(t.match, 1)]) <> l.subreddit """.format(index, index, index) for index in range(len(relations))]))
+    add_metadata_stubs_q = """ INSERT INTO t2_subreddit_metadata (subreddit, has_metadata)
+        SELECT DISTINCT target, 0 FROM snowball_ties ORDER BY target ON CONFLICT DO NOTHING """
+    count_level_q = """ SELECT COUNT(*) FROM snowball_level """
+    count_ties_q = """ SELECT relation, COUNT(*) FROM snowball_ties GROUP BY relation """
+
+    with transaction():
+        execute_in_db(create_level_q)
+        execute_in_db(create_ties_q, args = [sql_tie_pattern(relation.prefix) for relation in relations])
+        execute_in_db(""" ANALYZE snowball_ties """)
+        execute_in_db(add_metadata_stubs_q)
+
+        for index, relation in enumerate(relations):
+            enqueue_q = """ WITH added AS (INSERT INTO {} (subreddit, step)
+                SELECT target, MIN(step) + 1 FROM snowball_ties WHERE relation = %s GROUP BY target ORDER BY target
+                ON CONFLICT DO NOTHING RETURNING 1) SELECT COUNT(*) FROM added """.format(relation.queue_table)
+            insert_edges_q = """ WITH inserted AS (INSERT INTO {} (source, target, label)
+                SELECT source, target, NULL FROM snowball_ties WHERE relation = %s ORDER BY source, target
+                ON CONFLICT DO NOTHING RETURNING 1) SELECT COUNT(*) FROM inserted """.format(relation.edges_table)
+            set_processed_q = """ UPDATE {} q SET processed = 1 FROM snowball_level l WHERE q.subreddit = l.subreddit AND l.step{} IS NOT NULL """.format(relation.queue_table, index)
+
+            metrics.increment("subreddits_enqueued", execute_in_db(enqueue_q, return_first_only = True, args = [index])[0], queue = relation.queue_table)
+            metrics.increment("ties_found", execute_in_db(insert_edges_q, return_first_only = True, args = [index])[0], relation = relation.name)
+            execute_in_db(set_processed_q)
+
+        processed = execute_in_db(count_level_q, return_first_only = True)[0]
+        found = dict(execute_in_db(count_ties_q, return_results = True))
+
+    edge_counts = [found.get(index, 0) for index in range(len(relations))]
+    print("\t{} subreddits processed, {} edges found".format(processed, ", ".join(["{} {}".format(count, relation.name) for count, relation in zip(edge_counts, relations)])), flush = True)
+    return (processed, edge_counts)
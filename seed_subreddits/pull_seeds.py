@@ -1,12 +1,22 @@
-import json
-import requests
-from time import sleep, strftime
+import os
+import sys
+from time import strftime
+
+## The shared helper modules live in database_scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database_scripts"))
+import metrics
+from cassette import Cassette
+from keyword_search import pull_keywords, search_keywords
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from search_checkpoint import SearchCheckpoint
+from seed_output import SeedWriter
 
 '''
-Output: a json file with the following structure:
-- "keywords": a list of the search keywords used
-- "timestamp": the current timestamp when the results were dumped into the json file
-- "results": a list of search results, where each row has the following fields in order:
+Output: a JSON Lines file (gzipped), in the format described in seed_output.py:
+- a header line with "keywords" (the search keywords used) and "timestamp" (the
+  date the results were written), followed by
+- one search result per line, with the following fields in order:
     (1) search keyword,
     (2) subreddit name (i.e. r/something),
     (3) subreddit id (i.e. a string starting with t_),
@@ -15,128 +25,79 @@ Output: a json file with the following structure:
     (6) a link to the subreddit, and
     (7) the concatenation of the description and title (for easier text searching/matching).
     Note: Some fields may be empty if the subreddit is private or otherwise not publicly visible.
-'''
-
-def pull_keywords():
-    keywords = ["red pill", "redpill", "trp", "blue pill", "bluepill", "manosphere", "mra", "men's rights movement", "men's rights activists", "mgtow", "mghow", "men going their own way", "mgtower", "pua", "pickup artist", "pick-up artist", "feminism", "feminist", "misandry", "genderqueer", "trans", "ftm", "mtf", "transgender", "transsexual", "non-binary", "enby", "nonbinary", "chad", "stacy", "becky", "foid", "femoid", "alpha", "beta", "zeta", "incel"]
-    return keywords
-
-def extract_subreddits_from_json(result, keyword):
-
-    extracted_subreddits = []
-    subreddits = result["data"]["children"]
-
-    for sub_json in subreddits:
-
-        subreddit = sub_json["data"]["display_name"]
-        subreddit_title = sub_json["data"]["title"]
-        description = sub_json["data"]["description"]
-        link = "https://www.reddit.com/{}".format(sub_json["data"]["url"])
-        subreddit_id = sub_json["data"]["name"]
-        searched_text = " ".join([elt for elt in [subreddit_title, description] if elt])
-
-        row = (keyword, subreddit.lower(), subreddit_id, subreddit_title, description, link, searched_text)
-        extracted_subreddits.append(row)
-
-    return extracted_subreddits
-
-
-
-def pull_results(keyword):
-
-    keyword_rows = []
-
-    def make_request(after_id=None):
-        
-        print("\n\t\tInside make_request(after_id={})".format(after_id))
-        
-        search_endpoint = "https://www.reddit.com/subreddits/search.json"
-        search_headers = {"User-agent": "com.lgs17.searching_subreddits"}
-
-        search_params = {
-            "q": keyword,
-            "include_over_18": "on",
-            "limit": 100,
-            "show": "all",
-            "raw_json": 1
-        }
-
-        if after_id:
-            search_params["after"] = after_id
-
-        result = requests.get(search_endpoint, headers = search_headers, params = search_params)
-        # print("\t\t{}".format(result.url), flush=True)
-
-        if result.ok:
-            page_results = extract_subreddits_from_json(result.json(), keyword)
-            last_id = page_results[-1][2] if bool(page_results) else None
-            # print("\t\t{} results".format(len(page_results)), flush=True)
-            if len(page_results) == 0:
-                return None
-
-            if last_id != after_id:
-                keyword_rows.extend(page_results)
-            
-            # print("\t\tFirst result: {}".format(page_results[0][1]), flush=True)
-            # print("\t\tLast result: {}\n".format(page_results[-1][1]), flush=True)
 
-            return last_id
-
-        else:
-            print("\tBad response: {}".format(str(result)), flush=True)
-            return
-
-
-    new_after_id, after_id = make_request(), ""
-    request_count = 0
-
-    while bool(new_after_id):
-        # print("\n\tWhile Loop:", flush=True)
-        after_id = new_after_id
-        new_after_id = make_request(after_id=new_after_id)
-
-        request_count = request_count + 1
-        # print("\t\tRequests for {}: {}".format(keyword, str(request_count)), flush=True)
-
-        if (request_count % 60 == 0) or not bool(new_after_id):
-            print("\t\tCurrently collecting {}.... Request count #{}.... {} rows collected.... Sleeping 60 seconds.".format(keyword, request_count, len(keyword_rows)), flush=True)
-            # print("\t\tLast subreddit: {}".format(keyword_rows[-1][1]), flush=True)
-            sleep(60)
-
-        ## There are not enough results for a new iteration, so we're getting duplicates of the first results
-        if new_after_id == after_id:
-            new_after_id = None
-
-        # print("\t\tafter_id = {}, new_after_id = {}".format(after_id, new_after_id), flush=True)
-    
-    # print("\t{} rows collected.".format(len(keyword_rows)))
-    return keyword_rows
-
-
-
-keywords = pull_keywords()
-
-
-all_rows = []
-for index, keyword in enumerate(keywords):
-    print("{} rows collected.... ({}/{} or {}%)".format(len(all_rows), (index+1), len(keywords), int((index+1)*100/len(keywords))), flush=True)
-    print("CURRENT KEYWORD:\t{}".format(keyword))
-    keyword_rows = pull_results(keyword)
-    all_rows.extend(keyword_rows)
-
-
-print("Removing duplicates....", flush=True)
-all_rows = list(set(all_rows))
-print("{} rows collected. Now dumping to file....".format(len(all_rows)), flush=True)
-
-current_ts = strftime("%Y-%m-%d")
-
-with open("outputs/seeds_subreddits_collected_{}.json".format(current_ts), "w+") as f:
-    output = {
-        "keywords": keywords,
-        "timestamp": current_ts,
-        "results": all_rows
-    }
-    json.dump(output, f)
+The rows are written to the output file page by page as they come in.
+Progress is saved to `checkpoint_path` as each page lands; if the script stops
+partway, rerunning it continues from there. The checkpoint is deleted once
+every keyword is finished.
+'''
 
-print("Done!")
+checkpoint_path = "outputs/keyword_search_checkpoint.sqlite"
+
+## Number of keywords to page through at the same time
+search_workers = 4
+
+## Every search request takes a permit from here (unless it's answered from
+## the on-disk response cache)
+search_rate_limiter = RateLimiter(requests_per_minute = 60, name = "subreddit search")
+
+## Set to True to read search pages fetched within their time to live (by this
+## or any other script) from disk instead, without taking a permit (see
+## response_cache.py)
+use_response_cache = False
+
+## Set to a file name (e.g. "outputs/search_cassette.jsonl.gz") to record every
+## search page for an offline replay with fake_reddit.py (see cassette.py)
+cassette_path = None
+
+## Metrics (see metrics.py): a JSON snapshot is appended to `metrics_path`
+## every `metrics_interval` seconds; set `metrics_port` to also serve them to
+## Prometheus at http://127.0.0.1:PORT/metrics
+metrics_path = "outputs/keyword_search_metrics.jsonl"
+metrics_interval = 60
+metrics_port = None
+
+
+## The search only runs when this file is executed as a script, so importing
+## it doesn't open the response cache, a cassette or the checkpoint
+if __name__ == "__main__":
+    response_cache = ResponseCache() if use_response_cache else None
+    cassette = Cassette(cassette_path) if cassette_path else None
+
+    metrics.start(metrics_path, interval = metrics_interval, prometheus_port = metrics_port)
+    keywords = pull_keywords()
+    checkpoint = SearchCheckpoint(checkpoint_path)
+
+    current_ts = strftime("%Y-%m-%d")
+    with SeedWriter("outputs/seeds_subreddits_collected_{}.jsonl.gz".format(current_ts), keywords, current_ts) as writer:
+        ## A resumed run starts the file with the rows earlier runs saved
+        writer.write_rows(checkpoint.iter_rows())
+
+        ## Write each page of results to the output file as soon as it comes in
+        ## (the checkpoint only passes on the rows it didn't have yet, one per
+        ## (keyword, subreddit))
+        def add_rows(keyword, rows):
+            writer.write_rows(rows)
+
+        search_keywords(keywords, add_rows, num_workers = search_workers, rate_limiter = search_rate_limiter, checkpoint = checkpoint, cache = response_cache, cassette = cassette)
+
+    print("{} rows written to {}".format(writer.row_count, writer.path), flush=True)
+
+    ## Keep the checkpoint if any keyword stopped on a bad response, so a rerun
+    ## can finish it
+    unfinished = checkpoint.unfinished(keywords)
+    checkpoint.close()
+    if unfinished:
+        print("Unfinished keywords (rerun to continue): {}".format(", ".join(unfinished)), flush=True)
+    else:
+        os.remove(checkpoint_path)
+
+    search_rate_limiter.print_stats()
+    if response_cache:
+        response_cache.print_stats()
+        response_cache.close()
+    if cassette:
+        cassette.print_stats()
+        cassette.close()
+    metrics.stop()
+    print("Done!")
@@ -1,50 +1,87 @@
-from time import sleep, strftime
-import pandas as pd
-import praw
+from time import strftime
+import argparse
+import multiprocessing
 import prawcore
 import json
 import os
+import shutil
 import sys
+import zlib
 
+## The shared helper modules live in database_scripts/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database_scripts"))
+from rate_limiter import RateLimiter
+import reddit_api
+from account_status import AccountStatusCache
+from reddit_json import fetch_moderators
+from response_cache import ResponseCache, default_cache_path
+from seed_output import read_seed_file
+from metadata_store import MetadataStore, migrate_from_directory
 
-seed_subreddit_path = sys.argv[1]
-if not os.path.exists(seed_subreddit_path):
-    print("Seed file not found: ".format(seed_subreddit_path), flush=True)
-    quit()
+
+"""
+Pull metadata for every subreddit in a seed search output file.
+
+To run with one set of API credentials (from `reddit_config_path`):
+
+python seed_metadata.py outputs/seeds_subreddits_collected_<date>.jsonl.gz
+
+To split the work across K processes, each with its own API app credentials
+and its own rate budget:
+
+python seed_metadata.py SEED_FILE --workers 3 --reddit-configs app1.txt app2.txt app3.txt
+
+The remaining subreddits are partitioned deterministically (by a hash of the
+name), so a rerun gives every worker the same share. Each worker writes to its
+own shard store under outputs/subreddit_metadata_store/shards/, and the shards
+are merged into the main store once every worker is done (or at the start of
+the next run, if a run was interrupted).
+
+With --response-cache, API responses are cached on disk (`response_cache_path`,
+shared with the crawl scripts; see response_cache.py), so a rerun reads the
+subreddits it already fetched from disk.
+
+Moderators are read from each subreddit's moderator listing, and deleted and
+suspended accounts (stored as null) are found 100 at a time with an in-memory
+AccountStatusCache (see account_status.py) instead of by loading every
+moderator's profile.
+"""
 
 reddit_config_path = "/Users/lgs17/Desktop/Reddit Collab 2022/code/reddit_config.txt"
-if not os.path.exists(reddit_config_path):
-    print("Reddit creds file not found: ".format(reddit_config_path), flush=True)
-    quit()
 
+## Metadata records go into one append-only store (see metadata_store.py);
+## `subreddit_metadata_dir` is the old one-file-per-subreddit layout, which is
+## copied into the store the first time the store is opened
+subreddit_metadata_store_dir = "outputs/subreddit_metadata_store/"
 subreddit_metadata_dir = "outputs/subreddit_metadata/"
-if not os.path.exists(subreddit_metadata_dir):
-    print("Metadata output file not found: ".format(subreddit_metadata_dir), flush=True)
-subreddit_metadata_fpath = subreddit_metadata_dir + "{}.json"
+shards_dir = os.path.join(subreddit_metadata_store_dir, "shards")
+response_cache_path = default_cache_path
 
 current_ts = strftime("%Y-%m-%d")
 
-def init_reddit():
-    print("Creating Reddit object...", flush=True)
-    reddit_config = {}
-    with open(reddit_config_path) as f:
-        for line in f.readlines():
-            key, value = line.split("=")
-            reddit_config[key.strip()] = value.strip()
-        reddit = praw.Reddit(**reddit_config)
-        return reddit
-
-def pull_seed_subreddit_names_from_file():
-    print("Reading seed subreddit file...", flush=True)
-    with open(seed_subreddit_path) as f:
-        seed_data = json.load(f)
-        seed_subs = list(set([row[1] for row in seed_data["results"]]))
-        return sorted(seed_subs)
-
-def pull_already_collected_subreddit_names():
-    return [fpath.replace(".json", "") for fpath in os.listdir(subreddit_metadata_dir)]
+## Every API request in this process that isn't answered from `cache` takes a
+## permit from `rate_limiter`
+def init_reddit(reddit_config_path, rate_limiter, cache = None):
+    return reddit_api.init_reddit(reddit_config_path, rate_limiter = rate_limiter, cache = cache)
 
-def scrape_subreddit(reddit, subreddit_name, index):
+def pull_seed_subreddit_names_from_file(seed_subreddit_path):
+    print("Reading seed subreddit file...", flush=True)
+    _, rows = read_seed_file(seed_subreddit_path)
+    seed_subs = set([row[1] for row in rows])
+    return sorted(seed_subs)
+
+def open_metadata_store():
+    is_new_store = not os.path.exists(subreddit_metadata_store_dir)
+    store = MetadataStore(subreddit_metadata_store_dir)
+    if is_new_store and os.path.exists(subreddit_metadata_dir):
+        print("Migrating {} into {}...".format(subreddit_metadata_dir, subreddit_metadata_store_dir), flush=True)
+        migrate_from_directory(subreddit_metadata_dir, store)
+    return store
+
+def pull_already_collected_subreddit_names(store):
+    return store.names()
+
+def scrape_subreddit(reddit, session, account_status, subreddit_name, index):
     if index % 100 == 0:
         print("Scraping #{}: {}...".format(index, subreddit_name), flush=True)
 
@@ -52,17 +89,6 @@ def scrape_subreddit(reddit, subreddit_name, index):
     def get_subreddit(reddit, subreddit_name):
         return reddit.subreddit(subreddit_name)
 
-    ## Pull JSON data a post's author and cache it
-    def pull_author(author):
-        if author:
-            try:
-                _ = author.created_utc ## To force the lazy object to load
-
-            except (prawcore.exceptions.NotFound, AttributeError) as ex:
-                return
-
-            return author.name
-
     subreddit = get_subreddit(reddit, subreddit_name)
 
     try:
@@ -70,7 +96,15 @@ def scrape_subreddit(reddit, subreddit_name, index):
     except (prawcore.exceptions.NotFound, prawcore.exceptions.Forbidden, AttributeError) as ex:
         return
     
-    moderators = json.dumps([pull_author(moderator) for moderator in subreddit.moderator()])
+    ## [(username, account fullname)] from the listing; accounts that no
+    ## longer exist are stored as null. A subreddit whose listing or account
+    ## checks fail gets no row, like one that can't be loaded above.
+    try:
+        moderators = fetch_moderators(session, subreddit_name)
+        exists = account_status.check(session, moderators)
+    except (prawcore.exceptions.ResponseException, KeyError, TypeError):
+        return
+    moderators = json.dumps([username if exists.get(username, True) else None for username, _ in moderators])
 
     row = [subreddit_name] + [str(subreddit.__dict__.get(key)) for key in ["display_name", "free_form_reports", \
     "subreddit_type", "community_icon", "banner_background_image", "header_title", "over18", \
@@ -84,31 +118,112 @@ def scrape_subreddit(reddit, subreddit_name, index):
     "comment_score_hide_mins", "show_media_preview", "submission_type"]] + [moderators]
     return row
 
-def write_subreddit_metadata(subreddit, row):
-    with open(subreddit_metadata_fpath.format(subreddit), "w") as f:
-        output = {
-            "metadata": row,
-            "collected_date": current_ts
-        }
-        json.dump(output, f)
+def write_subreddit_metadata(store, subreddit, row):
+    store.append(subreddit, row, current_ts)
 
-def scrape_subreddit_metadata(subreddit_names):
-    reddit = init_reddit()
+## `cache_path` is the response cache to read and write (None for no cache)
+def scrape_subreddit_metadata(store, subreddit_names, reddit_config_path, cache_path = None):
+    rate_limiter = RateLimiter(requests_per_minute = 60)
+    cache = ResponseCache(cache_path) if cache_path else None
+    reddit = init_reddit(reddit_config_path, rate_limiter, cache = cache)
+    session = reddit_api.init_reddit_session(reddit_config_path, rate_limiter = rate_limiter, cache = cache)
+    account_status = AccountStatusCache(persist = False)
     for index, sub in enumerate(subreddit_names):
-        row = scrape_subreddit(reddit, sub, index)
-        write_subreddit_metadata(sub, row)
-
-subreddits_to_collect = pull_seed_subreddit_names_from_file()
-print("{} seed subreddits pulled from file.".format(len(subreddits_to_collect)), flush=True)
-
-already_collected = pull_already_collected_subreddit_names()
-print("{} seed subreddits already have metadata.".format(len(already_collected)), flush=True)
-
-subreddits_to_collect = list(set(subreddits_to_collect) - set(already_collected))
-print("{} seed subreddits remaining.".format(len(subreddits_to_collect)), flush=True)
-
-print("Beginning metadata collection...")
-scrape_subreddit_metadata(subreddits_to_collect)
-
-print("Done!")
-
+        row = scrape_subreddit(reddit, session, account_status, sub, index)
+        write_subreddit_metadata(store, sub, row)
+    rate_limiter.print_stats()
+    account_status.print_stats()
+    if cache:
+        cache.print_stats()
+        cache.close()
+
+
+#############################
+## Sharded (multi-process) ##
+#############################
+
+## Which of `num_shards` workers a subreddit belongs to (stable across runs)
+def shard_of(subreddit_name, num_shards):
+    return zlib.crc32(subreddit_name.encode("utf-8")) % num_shards
+
+def shard_store_dir(shard):
+    return os.path.join(shards_dir, "shard-{:02d}".format(shard))
+
+## Worker process: scrape this shard's subreddits into the shard's own store
+def run_shard(shard, subreddit_names, reddit_config_path, cache_path):
+    with MetadataStore(shard_store_dir(shard)) as shard_store:
+        remaining = [sub for sub in subreddit_names if sub not in shard_store]
+        print("Shard {}: {} subreddits remaining.".format(shard, len(remaining)), flush=True)
+        scrape_subreddit_metadata(shard_store, remaining, reddit_config_path, cache_path = cache_path)
+
+## Copy every shard's records into the main store, then delete the shards
+def merge_shards(store):
+    if not os.path.exists(shards_dir):
+        return
+    for shard_name in sorted(os.listdir(shards_dir)):
+        with MetadataStore(os.path.join(shards_dir, shard_name)) as shard_store:
+            merged = 0
+            for record in shard_store.iter_records():
+                if record["subreddit"] not in store:
+                    store.append(record["subreddit"], record["metadata"], record["collected_date"])
+                    merged += 1
+        print("Merged {} subreddits from {}.".format(merged, shard_name), flush=True)
+    shutil.rmtree(shards_dir)
+
+def scrape_subreddit_metadata_sharded(store, subreddit_names, reddit_config_paths, cache_path = None):
+    num_shards = len(reddit_config_paths)
+    shards = [[] for _ in range(num_shards)]
+    for sub in subreddit_names:
+        shards[shard_of(sub, num_shards)].append(sub)
+
+    workers = [multiprocessing.Process(target = run_shard, args = (shard, shards[shard], reddit_config_paths[shard], cache_path)) for shard in range(num_shards)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    merge_shards(store)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Pull metadata for the subreddits in a seed search output file")
+    parser.add_argument("seed_subreddit_path")
+    parser.add_argument("--workers", type = int, default = 1, help = "number of worker processes (one set of API credentials each)")
+    parser.add_argument("--reddit-configs", nargs = "+", default = [reddit_config_path], help = "one reddit config file per worker")
+    parser.add_argument("--response-cache", action = "store_true", help = "read and write the on-disk response cache shared with the crawl scripts")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.seed_subreddit_path):
+        print("Seed file not found: {}".format(args.seed_subreddit_path), flush=True)
+        quit()
+
+    if len(args.reddit_configs) != args.workers:
+        print("Need one reddit config file per worker ({} workers, {} files)".format(args.workers, len(args.reddit_configs)), flush=True)
+        quit()
+
+    for path in args.reddit_configs:
+        if not os.path.exists(path):
+            print("Reddit creds file not found: {}".format(path), flush=True)
+            quit()
+
+    subreddits_to_collect = pull_seed_subreddit_names_from_file(args.seed_subreddit_path)
+    print("{} seed subreddits pulled from file.".format(len(subreddits_to_collect)), flush=True)
+
+    store = open_metadata_store()
+    ## Pick up whatever an interrupted sharded run already collected
+    merge_shards(store)
+    already_collected = pull_already_collected_subreddit_names(store)
+    print("{} seed subreddits already have metadata.".format(len(already_collected)), flush=True)
+
+    subreddits_to_collect = [sub for sub in subreddits_to_collect if sub not in store]
+    print("{} seed subreddits remaining.".format(len(subreddits_to_collect)), flush=True)
+
+    print("Beginning metadata collection...")
+    cache_path = response_cache_path if args.response_cache else None
+    if args.workers == 1:
+        scrape_subreddit_metadata(store, subreddits_to_collect, args.reddit_configs[0], cache_path = cache_path)
+    else:
+        scrape_subreddit_metadata_sharded(store, subreddits_to_collect, args.reddit_configs, cache_path = cache_path)
+    store.close()
+
+    print("Done!")